@@ -2,42 +2,178 @@ import os
 
 import json
 import uuid
+import logging
+import threading
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, jsonify, flash, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image
 from flask_login import login_user, login_required, logout_user, current_user
-from itsdangerous import URLSafeTimedSerializer
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 
 from extensions import db, login_manager
-from models import User, Note, Tag
-
-app = Flask(__name__)
-
-# Configuration
-app.config['SECRET_KEY'] = 'dev-secret-key-change-in-prod' # TODO: Env var
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+from models import User, Note, Tag, NoteRevision
+from media_optimizer import optimize_file, DEFAULT_MAX_SIDE
+from tag_index import suggest_tags, find_or_create_tag, tag_applied, tag_removed, DEFAULT_SUGGESTIONS
+from autosave import apply_patch, replace_content, record_revision, delete_revisions, content_at, PatchError, VersionConflict
+from profiling import init_profiling
+from changefeed import record_change, tag_dict, latest_cursor, changes_since, prune_changes, parse_cursor, sse_stream, stream_slot, STREAM_SLOTS
+from perceptual_hash import dhash, to_hex, find_duplicate, media_added, same_image, DEFAULT_DISTANCE, MERGE_DISTANCE
+from sharding import SHARDED_TABLES, shard_binds, default_shard, shard_of, all_shards, shard_engine, select_shard, clear_shard, using_shard, ShardMoved
+
+# Import is side-effect free: no DB, filesystem or logging work happens until
+# create_app() runs, and Pillow/itsdangerous are only loaded by the routes that
+# need them. This keeps `gunicorn --preload 'app:create_app()'` cheap to fork.
 
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'gif'}
 MAX_CONTENT_LENGTH = 5 * 1024 * 1024  # 5MB limit
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
-
-# Initialize Extensions
-db.init_app(app)
-login_manager.init_app(app)
-login_manager.login_view = "login"
-login_manager.login_message = None # No popups
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# Create Tables
-with app.app_context():
-    db.create_all()
+bp = Blueprint('main', __name__)
+
+def create_app(config=None):
+    app = Flask(__name__)
+
+    # Configuration
+    app.config['SECRET_KEY'] = 'dev-secret-key-change-in-prod' # TODO: Env var
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    # Ingest-time image optimization (same policy as `python media_optimizer.py`)
+    app.config['OPTIMIZE_UPLOADS'] = os.environ.get('OPTIMIZE_UPLOADS', '0') == '1'
+    app.config['UPLOAD_MAX_SIDE'] = int(os.environ.get('UPLOAD_MAX_SIDE', DEFAULT_MAX_SIDE))
+    # Near-duplicate uploads (perceptual hash): 'off', 'flag' (mark the new item) or 'merge' (reuse the earlier file)
+    app.config['DUPLICATE_UPLOADS'] = os.environ.get('DUPLICATE_UPLOADS', 'flag')
+    app.config['DUPLICATE_DISTANCE'] = int(os.environ.get('DUPLICATE_DISTANCE', DEFAULT_DISTANCE))
+    app.config['DUPLICATE_MERGE_DISTANCE'] = int(os.environ.get('DUPLICATE_MERGE_DISTANCE', MERGE_DISTANCE))
+    # Live change-feed streams per worker process (each holds a thread; keep it below gunicorn --threads)
+    app.config['STREAM_SLOTS'] = int(os.environ.get('STREAM_SLOTS', STREAM_SLOTS))
+    # Create missing tables on the first request; deploys can run `flask --app app init-db` instead
+    app.config['AUTO_CREATE_SCHEMA'] = os.environ.get('AUTO_CREATE_SCHEMA', '1') == '1'
+    # Per-user databases: 0 keeps everything in app.db (move users with `python shard_tool.py`)
+    app.config['DB_SHARDS'] = int(os.environ.get('DB_SHARDS', '0'))
+    app.config['SHARD_URI_TEMPLATE'] = os.environ.get('SHARD_URI_TEMPLATE', 'sqlite:///shard_{}.db')
+    if config:
+        app.config.update(config)
+    app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}),
+                                      **shard_binds(app.config['DB_SHARDS'], app.config['SHARD_URI_TEMPLATE'])}
+
+    # Configure Logging
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+
+    # Initialize Extensions
+    db.init_app(app)
+    login_manager.init_app(app)
+    login_manager.login_view = "main.login"
+    login_manager.login_message = None # No popups
+
+    # Opt-in request profiler (registered first so it covers the other hooks)
+    init_profiling(app)
+
+    app.register_blueprint(bp)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create missing tables (run at deploy time)."""
+        init_schema(app)
+        print("Database schema is up to date.")
+
+    return app
+
+# --- Lazy Setup ---
+schema_lock = threading.Lock()
+schema_ready = set() # Database URIs already checked by this process
+
+# Columns added to existing tables after release (create_all() only creates missing tables)
+ADDED_COLUMNS = [
+    ('note', 'deleted_at', 'DATETIME'),
+    ('note', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('user', 'shard', 'INTEGER'),
+]
+
+def upgrade_columns(engine):
+    for table, column, ddl in ADDED_COLUMNS:
+        with engine.connect() as conn:
+            existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+            if not existing or column in existing: continue # Table not in this database
+            try:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                conn.commit()
+            except Exception:
+                conn.rollback() # Another worker got there first
+
+def create_tables(create):
+    # Workers start together: another one can create a table between our existence check and CREATE.
+    # Each such failure means one more table exists, so retrying always makes progress.
+    while True:
+        try:
+            return create()
+        except OperationalError as e:
+            if 'already exists' not in str(e): raise
+
+def init_schema(app):
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    with schema_lock:
+        if uri not in schema_ready:
+            with app.app_context():
+                create_tables(db.create_all)
+                # Shards only hold the per-user tables
+                tables = [t for t in db.metadata.sorted_tables if t.name in SHARDED_TABLES]
+                for shard in all_shards():
+                    engine = shard_engine(shard, db)
+                    if shard is not None:
+                        create_tables(lambda: db.metadata.create_all(bind=engine, tables=tables))
+                    upgrade_columns(engine)
+                if current_app.config['DB_SHARDS']: seed_id_sequence()
+            schema_ready.add(uri)
+
+def seed_id_sequence():
+    # Shared note/tag ids start above every id already written (e.g. before sharding was turned on)
+    top = 0
+    for shard in all_shards():
+        with shard_engine(shard, db).connect() as conn:
+            for table in ('note', 'tag'):
+                top = max(top, conn.execute(text(f"SELECT max(id) FROM {table}")).scalar() or 0)
+    if top:
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT OR IGNORE INTO id_sequence (id) VALUES (:id)"), {'id': top})
+
+@bp.before_app_request
+def ensure_schema():
+    # Runs once per worker process, before anything else touches the DB
+    if current_app.config['AUTO_CREATE_SCHEMA'] and current_app.config['SQLALCHEMY_DATABASE_URI'] not in schema_ready:
+        init_schema(current_app._get_current_object())
+
+@bp.before_app_request
+def route_to_shard():
+    # Per-user tables go to the logged-in user's database for this request
+    if current_user.is_authenticated:
+        select_shard(shard_of(current_user), current_user.id)
+    else:
+        clear_shard()
+
+@bp.teardown_app_request
+def release_shard(exc):
+    clear_shard()
+
+@bp.app_errorhandler(ShardMoved)
+def retry_after_move(e):
+    # The user's data moved mid-request and this write was rolled back; the retry goes to the new shard
+    response = jsonify({'status': 'error', 'message': 'Note storage moved, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def shard_key():
+    # Identifies where the client's change cursor came from ('main' or shard number)
+    shard = shard_of(current_user)
+    return 'main' if shard is None else str(shard)
+
+def shard_moved():
+    # Client's cursor came from another database (user was moved since the page loaded)
+    requested = request.args.get('shard')
+    return bool(requested) and requested != shard_key()
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -46,12 +182,34 @@ def load_user(user_id):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_upload(file):
+    # Returns the stored file name (may change extension when optimized)
+    filename = secure_filename(file.filename)
+    unique_name = f"{uuid.uuid4().hex}_{filename}"
+    os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_name)
+    file.save(file_path)
+
+    if current_app.config['OPTIMIZE_UPLOADS'] and not unique_name.lower().endswith('.gif'):
+        try:
+            result = optimize_file(file_path, max_side=current_app.config['UPLOAD_MAX_SIDE'])
+            if result['new_path'] != file_path:
+                os.remove(file_path)
+                unique_name = os.path.basename(result['new_path'])
+        except Exception as e:
+            print(f"Optimize error: {e}") # Keep the original
+    return unique_name
+
+def reset_serializer():
+    from itsdangerous import URLSafeTimedSerializer # Only the reset flow needs it
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+
 # --- Auth Routes ---
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     if request.method == 'POST':
         email = request.form.get('email')
@@ -60,11 +218,11 @@ def register():
         
         if not email or not name or not password:
             flash('All fields are required.')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
         if User.query.filter_by(email=email).first():
             flash('Email already exists.')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
         new_user = User(
             email=email, 
@@ -72,17 +230,19 @@ def register():
             password_hash=generate_password_hash(password, method='scrypt')
         )
         db.session.add(new_user)
+        db.session.flush()
+        new_user.shard = default_shard(new_user.id)
         db.session.commit()
         
         login_user(new_user)
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
         
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
         
     if request.method == 'POST':
         email = request.form.get('email')
@@ -92,17 +252,13 @@ def login():
         if user and check_password_hash(user.password_hash, password):
             remember = True if request.form.get('remember') else False
             login_user(user, remember=remember)
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
             flash('Invalid email or password.')
             
     return render_template('login.html')
 
 # --- Security Helpers ---
-import logging
-
-# Configure Logging
-logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
 security_logger = logging.getLogger('security')
 
 # In-Memory Rate Limit Store: { 'email': [timestamp1, timestamp2, ...] }
@@ -122,10 +278,10 @@ def check_rate_limit(email):
     RESET_REQUESTS[email].append(now)
     return True
 
-@app.route('/forgot-password', methods=['GET', 'POST'])
+@bp.route('/forgot-password', methods=['GET', 'POST'])
 def forgot_password():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     if request.method == 'POST':
         email = request.form.get('email')
@@ -134,17 +290,17 @@ def forgot_password():
         if not check_rate_limit(email):
             security_logger.warning(f"RATE LIMIT EXCEEDED: Password reset attempt for {email} from {request.remote_addr}")
             flash('Too many requests. Please try again in an hour.')
-            return redirect(url_for('forgot_password'))
+            return redirect(url_for('main.forgot_password'))
 
         user = User.query.filter_by(email=email).first()
         
         if user:
             # Generate Token
-            s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+            s = reset_serializer()
             token = s.dumps(email, salt='password-reset-salt')
             
             # Simulate Email Sending (Print to Console)
-            reset_url = url_for('reset_password', token=token, _external=True)
+            reset_url = url_for('main.reset_password', token=token, _external=True)
             print("="*50)
             print(f"MOCK EMAIL TO: {email}")
             print(f"RESET LINK: {reset_url}")
@@ -157,22 +313,22 @@ def forgot_password():
             security_logger.info(f"RESET ATTEMPT: Non-existent email {email} from {request.remote_addr}")
             flash('Password reset link has been sent to your email (Check Terminal Console).')
             
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
         
     return render_template('forgot_password.html')
 
-@app.route('/reset-password/<token>', methods=['GET', 'POST'])
+@bp.route('/reset-password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
-    s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+    s = reset_serializer()
     try:
         email = s.loads(token, salt='password-reset-salt', max_age=1800) # 30 Minutes Expiry
     except:
         security_logger.warning(f"RESET FAILED: Invalid/Expired token from {request.remote_addr}")
         flash('The password reset link is invalid or has expired.')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
         
     if request.method == 'POST':
         password = request.form.get('password')
@@ -180,7 +336,7 @@ def reset_password(token):
         
         if password != confirm_password:
             flash('Passwords do not match.')
-            return redirect(url_for('reset_password', token=token))
+            return redirect(url_for('main.reset_password', token=token))
             
         user = User.query.filter_by(email=email).first()
         if user:
@@ -188,28 +344,31 @@ def reset_password(token):
             db.session.commit()
             flash('Your password has been updated! You can now log in.')
             security_logger.info(f"RESET SUCCESS: Password changed for {email} from {request.remote_addr}")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         else:
             flash('User not found.')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
             
     return render_template('reset_password.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 # --- App Routes ---
 
-@app.route('/')
+@bp.route('/')
 def index():
     # Public Landing Page
     if not current_user.is_authenticated:
         return render_template('landing.html')
 
     # App Workspace (Logged In)
+    # Sync cursor first: anything committed after this is picked up by the change feed
+    change_cursor = latest_cursor()
+
     # Sort: Pinned DESC, Created DESC (Updated ignored)
     items = Note.query.filter_by(user_id=current_user.id, deleted=False)\
         .order_by(Note.pinned.desc(), Note.created_at.desc()).all()
@@ -230,9 +389,9 @@ def index():
     # Fetch Tags for Label Bar
     tags = Tag.query.filter_by(user_id=current_user.id).order_by(Tag.name).all()
         
-    return render_template('index.html', items=display_items, tags=tags)
+    return render_template('index.html', items=display_items, tags=tags, change_cursor=change_cursor, change_shard=shard_key())
 
-@app.route('/bin')
+@bp.route('/bin')
 @login_required
 def view_bin():
     # Bin Sort: Created DESC (Consistent)
@@ -261,7 +420,7 @@ from flask import abort
 # --- Auto Purge Logic ---
 last_purge_run = None
 
-@app.before_request
+@bp.before_app_request
 def purge_deleted_notes():
     global last_purge_run
     # Throttle: Run at most once every 6 hours
@@ -271,14 +430,18 @@ def purge_deleted_notes():
     # Check tables exist first to avoid startup errors
     try:
         cutoff = datetime.now() - timedelta(days=30)
-        notes_to_purge = Note.query.filter(Note.deleted == True, Note.deleted_at < cutoff).all()
-        
-        for note in notes_to_purge:
-            # Here we would delete physical files if we were rigorous, but for now just DB record
-            db.session.delete(note)
-            
-        if notes_to_purge:
-            db.session.commit()
+        for shard in all_shards():
+            with using_shard(shard):
+                notes_to_purge = Note.query.filter(Note.deleted == True, Note.deleted_at < cutoff).all()
+
+                for note in notes_to_purge:
+                    # Here we would delete physical files if we were rigorous, but for now just DB record
+                    record_change(note.user_id, 'note.purged', note.id)
+                    delete_revisions(note.id)
+                    db.session.delete(note)
+
+                prune_changes()
+                db.session.commit()
             
         last_purge_run = datetime.now()
     except:
@@ -286,7 +449,7 @@ def purge_deleted_notes():
 
 # ... (Rest of App)
 
-@app.route('/update/<int:id>', methods=['POST'])
+@bp.route('/update/<int:id>', methods=['POST'])
 @login_required
 def update(id):
     note = Note.query.filter_by(id=id, user_id=current_user.id).first_or_404()
@@ -298,16 +461,66 @@ def update(id):
     data = request.get_json()
     if data:
         # JSON Update
+        if 'content' in data:
+            # Full replace: new version (only if nobody saved since `base`), history gets a snapshot
+            base = data.get('base')
+            try:
+                replace_content(note, data['content'], base if isinstance(base, int) else None)
+            except VersionConflict as e:
+                return jsonify({'status': 'conflict', 'version': e.note.version, 'content': e.note.content}), 409
         if 'title' in data: note.title = data['title']
-        if 'content' in data: note.content = data['content']
         if 'pinned' in data: note.pinned = data['pinned']
         
+        fields = {k: data[k] for k in ('title', 'content', 'pinned') if k in data}
+        if fields:
+            record_change(current_user.id, 'note.updated', note.id, fields=fields, version=note.version)
         db.session.commit()
-        return jsonify({'status': 'success'})
+        return jsonify({'status': 'success', 'version': note.version})
         
     return jsonify({'status': 'error'}), 400
 
-@app.route('/bin_action/<int:id>/<action>', methods=['POST'])
+@bp.route('/notes/<int:note_id>/patch', methods=['POST'])
+@login_required
+def patch_content(note_id):
+    # Delta autosave: positional ops against a known base version
+    note = Note.query.filter_by(id=note_id, user_id=current_user.id).first_or_404()
+    if note.deleted: abort(403)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('base'), int):
+        return jsonify({'status': 'error', 'message': 'base version required'}), 400
+
+    try:
+        version = apply_patch(note, data['base'], data.get('ops'))
+    except VersionConflict as e:
+        # Client merges its edit into the current content and retries
+        return jsonify({'status': 'conflict', 'version': e.note.version, 'content': e.note.content}), 409
+    except PatchError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    record_change(current_user.id, 'note.patched', note.id, version=version)
+    db.session.commit()
+    return jsonify({'status': 'success', 'version': version})
+
+@bp.route('/notes/<int:note_id>/revisions', methods=['GET'])
+@login_required
+def note_revisions(note_id):
+    note = Note.query.filter_by(id=note_id, user_id=current_user.id).first_or_404()
+
+    version = request.args.get('version', type=int)
+    if version is not None:
+        if version > note.version: abort(404) # Not written yet
+        content = note.content if version == note.version else content_at(note.id, version)
+        if content is None: abort(404) # Compacted away
+        return jsonify({'version': version, 'content': content})
+
+    revisions = NoteRevision.query.filter_by(note_id=note.id).order_by(NoteRevision.version.desc()).all()
+    return jsonify({
+        'version': note.version,
+        'revisions': [{'version': r.version, 'kind': r.kind, 'created_at': r.created_at.isoformat()} for r in revisions]
+    })
+
+@bp.route('/bin_action/<int:id>/<action>', methods=['POST'])
 @login_required
 def bin_action(id, action):
     note = Note.query.filter_by(id=id, user_id=current_user.id).first_or_404()
@@ -315,16 +528,20 @@ def bin_action(id, action):
     if action == 'delete':
         note.deleted = True
         note.deleted_at = datetime.now() # Set timestamp (Local)
+        record_change(current_user.id, 'note.deleted', note.id)
     elif action == 'restore':
         note.deleted = False
         note.deleted_at = None # Clear timestamp
+        record_change(current_user.id, 'note.restored', note.id)
     elif action == 'permanent':
+        record_change(current_user.id, 'note.purged', note.id)
+        delete_revisions(note.id)
         db.session.delete(note)
         
     db.session.commit()
-    return redirect(url_for('index' if action == 'restore' else 'view_bin'))
+    return redirect(url_for('main.index' if action == 'restore' else 'main.view_bin'))
 
-@app.route('/add', methods=['POST'])
+@bp.route('/add', methods=['POST'])
 @login_required
 def add():
     title = request.form.get('title', '').strip()
@@ -342,7 +559,7 @@ def add():
         
     # vFinal Rule: Empty Notes = Ghost Delete
     if not title and not content and not media:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     # Auto-Title if missing
     if not title and content:
@@ -356,47 +573,52 @@ def add():
         created_at=datetime.now() # USE LOCAL
     )
     db.session.add(new_note)
+    db.session.flush() # Need the ID for the change feed
+    record_change(current_user.id, 'note.created', new_note.id)
     db.session.commit()
     
-    return redirect(url_for('index', _anchor='app-workspace'))
+    return redirect(url_for('main.index', _anchor='app-workspace'))
 
 # --- Legacy Soft Delete Route (Mapped to new logic) ---
-@app.route('/delete/<int:item_id>', methods=['POST'])
+@bp.route('/delete/<int:item_id>', methods=['POST'])
 @login_required
 def soft_delete(item_id):
     # This was the old route for inline delete
     return bin_action(item_id, 'delete')
 
-@app.route('/restore/<int:item_id>', methods=['POST'])
+@bp.route('/restore/<int:item_id>', methods=['POST'])
 @login_required
 def restore(item_id):
     return bin_action(item_id, 'restore')
 
-@app.route('/permanent_delete/<int:item_id>', methods=['POST'])
+@bp.route('/permanent_delete/<int:item_id>', methods=['POST'])
 @login_required
 def permanent_delete(item_id):
     return bin_action(item_id, 'permanent')
 
-@app.route('/restore_all', methods=['POST'])
+@bp.route('/restore_all', methods=['POST'])
 @login_required
 def restore_all():
     items = Note.query.filter_by(user_id=current_user.id, deleted=True).all()
     for item in items:
         item.deleted = False
         item.deleted_at = None
+        record_change(current_user.id, 'note.restored', item.id)
     db.session.commit()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/erase_all', methods=['POST'])
+@bp.route('/erase_all', methods=['POST'])
 @login_required
 def erase_all():
     items = Note.query.filter_by(user_id=current_user.id, deleted=True).all()
     for item in items:
+        record_change(current_user.id, 'note.purged', item.id)
+        delete_revisions(item.id)
         db.session.delete(item)
     db.session.commit()
-    return redirect(url_for('view_bin'))
+    return redirect(url_for('main.view_bin'))
 
-@app.route('/media/<note_id>/<media_id>/delete', methods=['POST'])
+@bp.route('/media/<note_id>/<media_id>/delete', methods=['POST'])
 @login_required
 def delete_media(note_id, media_id):
     note = Note.query.filter_by(id=note_id, user_id=current_user.id).first_or_404()
@@ -408,12 +630,13 @@ def delete_media(note_id, media_id):
         media_list = json.loads(note.media_json)
         new_list = [m for m in media_list if m.get('id') != media_id]
         note.media_json = json.dumps(new_list)
+        record_change(current_user.id, 'note.media', note.id)
         db.session.commit()
         return jsonify({'status': 'success'})
     except:
         return jsonify({'status': 'error'}), 500
 
-@app.route('/note/<int:note_id>/add_media', methods=['POST'])
+@bp.route('/note/<int:note_id>/add_media', methods=['POST'])
 @login_required
 def add_media_to_note(note_id):
     note = Note.query.filter_by(id=note_id, user_id=current_user.id).first_or_404()
@@ -436,46 +659,64 @@ def add_media_to_note(note_id):
     for file in files:
         if file.filename == '' or not allowed_file(file.filename): continue
         
-        filename = secure_filename(file.filename)
-        unique_name = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_name)
-        file.save(file_path)
+        unique_name = save_upload(file)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_name)
         url = url_for('static', filename=f'uploads/{unique_name}')
         
         # Generate Thumbnail
         thumb_unique_name = f"thumb_{unique_name}"
-        thumb_path = os.path.join(app.config['UPLOAD_FOLDER'], thumb_unique_name)
+        thumb_path = os.path.join(current_app.config['UPLOAD_FOLDER'], thumb_unique_name)
         thumb_url = url # Fallback
+        phash = None
         
         try:
+            from PIL import Image # Deferred: keeps Pillow out of worker start-up
             with Image.open(file_path) as img:
                 # Convert to RGB if RGBA (for JPEG saving)
                 if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
                 img.thumbnail((600, 600)) 
                 img.save(thumb_path, "JPEG", quality=75, optimize=True)
+                phash = dhash(img)
             thumb_url = url_for('static', filename=f'uploads/{thumb_unique_name}')
         except Exception as e:
             print(f"Thumbnail error: {e}")
 
         new_media_item = {'id': str(uuid.uuid4()), 'type': 'image', 'url': url, 'thumbnail_url': thumb_url}
+        if phash is not None:
+            new_media_item['phash'] = to_hex(phash)
+            duplicate = None
+            if current_app.config['DUPLICATE_UPLOADS'] in ('flag', 'merge'):
+                duplicate = find_duplicate(current_user.id, phash, current_app.config['DUPLICATE_DISTANCE'])
+            if duplicate:
+                bits, earlier = duplicate
+                new_media_item['duplicate_of'] = earlier['url']
+                earlier_path = os.path.join(current_app.config['UPLOAD_FOLDER'], os.path.basename(earlier['url']))
+                if current_app.config['DUPLICATE_UPLOADS'] == 'merge' and bits <= current_app.config['DUPLICATE_MERGE_DISTANCE'] \
+                        and same_image(file_path, earlier_path):
+                    # Same picture already stored: point at it and drop the new copy
+                    for path in (file_path, thumb_path):
+                        if os.path.exists(path): os.remove(path)
+                    new_media_item['url'] = earlier['url']
+                    new_media_item['thumbnail_url'] = earlier['thumbnail_url'] or earlier['url']
+            media_added(current_user.id, note.id, new_media_item)
         media.append(new_media_item)
         added_items.append(new_media_item)
     
     note.media_json = json.dumps(media)
+    if added_items:
+        record_change(current_user.id, 'note.media', note.id)
     db.session.commit()
     
     return jsonify({'status': 'success', 'media_list': added_items})
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
     if 'file' not in request.files: return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
     if file.filename == '' or not allowed_file(file.filename): return jsonify({'error': 'Invalid file'}), 400
     
-    filename = secure_filename(file.filename)
-    unique_name = f"{uuid.uuid4().hex}_{filename}"
-    file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_name))
+    unique_name = save_upload(file)
     
     url = url_for('static', filename=f'uploads/{unique_name}')
     return jsonify({'status': 'success', 'url': url})
@@ -484,13 +725,21 @@ def upload_file():
 
 # --- Tag Routes ---
 
-@app.route('/tags', methods=['GET'])
+@bp.route('/tags', methods=['GET'])
 @login_required
 def get_tags():
     tags = Tag.query.filter_by(user_id=current_user.id).all()
     return jsonify([{'id': t.id, 'name': t.name, 'color': t.color} for t in tags])
 
-@app.route('/tags', methods=['POST'])
+@bp.route('/tags/suggest', methods=['GET'])
+@login_required
+def suggest_tag_names():
+    # Autocomplete: case-insensitive prefix match, most used / recent first
+    q = request.args.get('q', '')[:50]
+    limit = request.args.get('limit', DEFAULT_SUGGESTIONS, type=int)
+    return jsonify(suggest_tags(current_user.id, q, limit))
+
+@bp.route('/tags', methods=['POST'])
 @login_required
 def create_tag():
     data = request.get_json()
@@ -498,16 +747,13 @@ def create_tag():
     if not name: return jsonify({'status': 'error'}), 400
     
     # Check duplicate
-    existing = Tag.query.filter_by(user_id=current_user.id, name=name).first()
-    if existing:
-        return jsonify({'id': existing.id, 'name': existing.name, 'color': existing.color})
-    
-    new_tag = Tag(user_id=current_user.id, name=name)
-    db.session.add(new_tag)
-    db.session.commit()
-    return jsonify({'id': new_tag.id, 'name': new_tag.name, 'color': new_tag.color})
+    tag, created = find_or_create_tag(current_user.id, name)
+    if created:
+        record_change(current_user.id, 'tag.created', tag=tag_dict(tag))
+        db.session.commit()
+    return jsonify({'id': tag.id, 'name': tag.name, 'color': tag.color})
 
-@app.route('/notes/<int:note_id>/tags', methods=['POST'])
+@bp.route('/notes/<int:note_id>/tags', methods=['POST'])
 @login_required
 def add_tag_to_note(note_id):
     note = Note.query.filter_by(id=note_id, user_id=current_user.id).first_or_404()
@@ -518,19 +764,19 @@ def add_tag_to_note(note_id):
     if not tag_name: return jsonify({'status': 'error'}), 400
     
     # Find or Create Tag
-    tag = Tag.query.filter_by(user_id=current_user.id, name=tag_name).first()
-    if not tag:
-        tag = Tag(user_id=current_user.id, name=tag_name)
-        db.session.add(tag)
-        db.session.commit()
+    tag, created = find_or_create_tag(current_user.id, tag_name)
+    if created:
+        record_change(current_user.id, 'tag.created', tag=tag_dict(tag))
         
     if tag not in note.tags:
         note.tags.append(tag)
-        db.session.commit()
+        tag_applied(current_user.id, tag.id, note.id)
+        record_change(current_user.id, 'note.tags', note.id, tags=[tag_dict(t) for t in note.tags])
+    db.session.commit()
         
     return jsonify({'status': 'success', 'tag': {'id': tag.id, 'name': tag.name, 'color': tag.color}})
 
-@app.route('/notes/<int:note_id>/tags/<int:tag_id>', methods=['DELETE'])
+@bp.route('/notes/<int:note_id>/tags/<int:tag_id>', methods=['DELETE'])
 @login_required
 def remove_tag_from_note(note_id, tag_id):
     note = Note.query.filter_by(id=note_id, user_id=current_user.id).first_or_404()
@@ -539,22 +785,25 @@ def remove_tag_from_note(note_id, tag_id):
     tag = Tag.query.get_or_404(tag_id)
     if tag in note.tags:
         note.tags.remove(tag)
+        tag_removed(current_user.id, tag.id, note.id)
+        record_change(current_user.id, 'note.tags', note.id, tags=[tag_dict(t) for t in note.tags])
         db.session.commit()
         
     return jsonify({'status': 'success'})
 
 
-@app.route('/pin/<int:item_id>', methods=['POST'])
+@bp.route('/pin/<int:item_id>', methods=['POST'])
 @login_required
 def toggle_pin(item_id):
     note = Note.query.filter_by(id=item_id, user_id=current_user.id).first_or_404()
     data = request.json
     if 'pinned' in data:
         note.pinned = bool(data['pinned'])
+        record_change(current_user.id, 'note.updated', note.id, fields={'pinned': note.pinned})
         db.session.commit()
     return jsonify({'status': 'success', 'pinned': note.pinned})
 
-@app.route('/tags/batch_apply', methods=['POST'])
+@bp.route('/tags/batch_apply', methods=['POST'])
 @login_required
 def batch_apply_tag():
     data = request.get_json()
@@ -564,11 +813,9 @@ def batch_apply_tag():
     if not tag_name: return jsonify({'status': 'error', 'message': 'Tag name required'}), 400
     
     # 1. Find or Create Tag
-    tag = Tag.query.filter_by(user_id=current_user.id, name=tag_name).first()
-    if not tag:
-        tag = Tag(user_id=current_user.id, name=tag_name)
-        db.session.add(tag)
-        db.session.flush() # Get ID without commit yet
+    tag, created = find_or_create_tag(current_user.id, tag_name)
+    if created:
+        record_change(current_user.id, 'tag.created', tag=tag_dict(tag))
         
     # 2. Batch Apply
     count = 0
@@ -577,6 +824,8 @@ def batch_apply_tag():
         for note in notes:
             if tag not in note.tags:
                 note.tags.append(tag)
+                tag_applied(current_user.id, tag.id, note.id)
+                record_change(current_user.id, 'note.tags', note.id, tags=[tag_dict(t) for t in note.tags])
                 count += 1
                 
     db.session.commit()
@@ -588,5 +837,57 @@ def batch_apply_tag():
     })
 
 
+# --- Sync Routes (Change Feed) ---
+
+@bp.route('/changes', methods=['GET'])
+@login_required
+def get_changes():
+    # Catch-up API: deltas after ?since=<cursor>
+    cursor = parse_cursor(request.args.get('since'))
+    if shard_moved():
+        return jsonify({'events': [], 'cursor': 0, 'reset': True})
+    events, reset = changes_since(current_user.id, cursor)
+    return jsonify({
+        'events': events,
+        'cursor': events[-1]['id'] if events else cursor,
+        'reset': reset
+    })
+
+@bp.route('/changes/stream', methods=['GET'])
+@login_required
+def stream_changes():
+    # Resumable SSE: EventSource re-sends Last-Event-ID on reconnect
+    cursor = parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    if shard_moved():
+        return Response("event: reset\ndata: {}\n\n", mimetype='text/event-stream')
+
+    def stream(user_id, shard, slots):
+        with stream_slot(slots) as granted:
+            if not granted:
+                # Every stream thread of this worker is busy: switch this tab to polling
+                yield "event: poll\ndata: {}\n\n"
+                return
+            # Pin the shard: the body is iterated after the route returns
+            with using_shard(shard):
+                yield from sse_stream(user_id, cursor)
+
+    slots = current_app.config['STREAM_SLOTS']
+    response = Response(stream_with_context(stream(current_user.id, shard_of(current_user), slots)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Don't buffer behind proxies
+    return response
+
+@bp.route('/notes/<int:note_id>/card', methods=['GET'])
+@login_required
+def note_card(note_id):
+    # Rendered grid card, used by the sync client to insert/replace a single note
+    note = Note.query.filter_by(id=note_id, user_id=current_user.id, deleted=False).first_or_404()
+    try:
+        note.media = json.loads(note.media_json)
+    except:
+        note.media = []
+    return render_template('_note_card.html', item=note)
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,139 @@
+import json
+from datetime import datetime
+
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from extensions import db
+from models import Note, NoteRevision
+from sharding import check_home
+
+# --- Delta Autosave ---
+# Clients send positional patches against the version they last saw:
+#   {"base": 7, "ops": [{"at": 120, "del": 3, "ins": "new"}, ...]}
+# Offsets are UTF-16 code units (what JS string indices are), ops apply in order.
+
+SNAPSHOT_EVERY = 50   # Full content snapshot every N versions
+KEEP_SNAPSHOTS = 10   # History kept per note: the last N snapshots and patches since
+MAX_OPS = 100         # Per request
+
+
+class PatchError(ValueError):
+    pass
+
+
+class VersionConflict(Exception):
+    def __init__(self, note):
+        super().__init__(f"note {note.id} is at version {note.version}")
+        self.note = note
+
+
+def apply_ops(content, ops):
+    if not isinstance(ops, list) or len(ops) > MAX_OPS:
+        raise PatchError('ops must be a list of at most %d items' % MAX_OPS)
+
+    buf = (content or '').encode('utf-16-le') # 2 bytes per JS code unit
+    for op in ops:
+        try:
+            at, delete, insert = int(op['at']), int(op.get('del', 0)), op.get('ins', '')
+        except (KeyError, TypeError, ValueError):
+            raise PatchError('malformed op')
+        if not isinstance(insert, str) or at < 0 or delete < 0 or (at + delete) * 2 > len(buf):
+            raise PatchError('op out of range')
+        buf = buf[:at * 2] + insert.encode('utf-16-le', 'surrogatepass') + buf[(at + delete) * 2:]
+
+    try:
+        return buf.decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise PatchError('patch splits a surrogate pair')
+
+
+def apply_patch(note, base, ops):
+    """Apply ops to note.content if it is still at `base`. Caller commits."""
+    if note.version != base:
+        raise VersionConflict(note)
+
+    content = apply_ops(note.content, ops)
+    _swap(note, base, content)
+    record_revision(note, ops)
+    return note.version
+
+
+def replace_content(note, content, base=None):
+    """Full save: `content` becomes the next version if the note is still at `base`
+    (default: the version it was loaded at). Caller commits."""
+    base = note.version if base is None else base
+    if note.version != base:
+        raise VersionConflict(note)
+
+    _swap(note, base, content)
+    record_revision(note)
+    return note.version
+
+
+def _swap(note, base, content):
+    # Compare-and-swap: a concurrent save from another worker makes this match nothing,
+    # so two different texts never share a version number
+    updated = Note.query.filter_by(id=note.id, version=base)\
+        .update({'content': content, 'version': base + 1}, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        try:
+            db.session.refresh(note)
+        except InvalidRequestError:
+            check_home(db) # Row gone because the user moved shards: ShardMoved, the client retries
+            raise
+        raise VersionConflict(note)
+
+    # Already written by the UPDATE above: mirror it without marking the note dirty
+    set_committed_value(note, 'content', content)
+    set_committed_value(note, 'version', base + 1)
+
+
+def record_revision(note, ops=None):
+    """Log the change that produced note.version (ops=None: full replace)."""
+    snapshot = ops is None or note.version % SNAPSHOT_EVERY == 0 or \
+        not NoteRevision.query.filter_by(note_id=note.id, kind='snapshot').first()
+
+    db.session.add(NoteRevision(
+        note_id=note.id,
+        version=note.version,
+        kind='snapshot' if snapshot else 'patch',
+        data=note.content if snapshot else json.dumps(ops),
+        created_at=datetime.now()
+    ))
+    if snapshot:
+        db.session.flush()
+        compact_revisions(note.id)
+
+
+def compact_revisions(note_id):
+    # Drop everything older than the oldest snapshot we keep
+    versions = [v for (v,) in db.session.query(NoteRevision.version)
+                .filter_by(note_id=note_id, kind='snapshot')
+                .order_by(NoteRevision.version.desc()).limit(KEEP_SNAPSHOTS)]
+    if len(versions) == KEEP_SNAPSHOTS:
+        NoteRevision.query.filter(NoteRevision.note_id == note_id, NoteRevision.version < versions[-1])\
+            .delete(synchronize_session=False)
+
+
+def delete_revisions(note_id):
+    NoteRevision.query.filter_by(note_id=note_id).delete(synchronize_session=False)
+
+
+def content_at(note_id, version):
+    """Rebuild content at `version` from the nearest snapshot, or None if pruned."""
+    snapshot = NoteRevision.query.filter(
+        NoteRevision.note_id == note_id, NoteRevision.kind == 'snapshot', NoteRevision.version <= version
+    ).order_by(NoteRevision.version.desc()).first()
+    if not snapshot:
+        return None
+
+    content = snapshot.data
+    patches = NoteRevision.query.filter(
+        NoteRevision.note_id == note_id, NoteRevision.kind == 'patch',
+        NoteRevision.version > snapshot.version, NoteRevision.version <= version
+    ).order_by(NoteRevision.version).all()
+    for patch in patches:
+        content = apply_ops(content, json.loads(patch.data))
+    return content
@@ -0,0 +1,154 @@
+"""Concurrent multi-user write throughput for different shard counts.
+
+    python bench_shards.py
+    python bench_shards.py --shards 1,2,4,8 --workers 8 --seconds 5
+    python bench_shards.py --direct
+
+Each worker process is one user saving their note through /update as fast
+as it can, like autosave traffic from many people at once. Users are placed
+with default_shard(), as registration does, so with more shards fewer of
+them share a SQLite write lock ("busiest" is the most users on one shard).
+Sharding only pays off once that lock is the bottleneck (more busy workers
+than a single file can commit for, or slow fsync); on a machine with fewer
+cores than workers the request handling itself is the ceiling, and --direct
+(same model writes, no HTTP) shows the storage side. Throwaway databases
+are created under --dir (default instance/, so the numbers include the real
+disk's fsync cost); instance/app.db is never touched.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def bench_config(tmp, shards):
+    return {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'main.db')}",
+        'SHARD_URI_TEMPLATE': f"sqlite:///{os.path.join(tmp, 'shard_{}.db')}",
+        'DB_SHARDS': shards,
+        'PROFILE_SAMPLE_RATE': 0,
+    }
+
+
+def setup(config, users):
+    # Returns (user_id, note_id, shard) per user
+    from app import create_app, init_schema
+    from extensions import db
+    from models import User, Note
+    from sharding import default_shard, using_shard
+
+    app = create_app(config)
+    init_schema(app)
+    note_ids = []
+    with app.app_context():
+        for i in range(users):
+            user = User(email=f"bench{i}@example.com", name=f"Bench {i}", password_hash='-')
+            db.session.add(user)
+            db.session.flush()
+            user.shard = default_shard(user.id)
+            db.session.commit()
+            with using_shard(user.shard):
+                note = Note(user_id=user.id, title='Bench', content='')
+                db.session.add(note)
+                db.session.commit()
+                note_ids.append((user.id, note.id, user.shard))
+        for engine in db.engines.values(): engine.dispose() # No pooled connections across fork
+    return note_ids
+
+
+def save_direct(app, user_id, note_id, shard, text):
+    # What /update does for a content change, minus the HTTP layer
+    from autosave import record_revision
+    from changefeed import record_change
+    from extensions import db
+    from models import Note
+    from sharding import using_shard
+
+    with app.app_context(), using_shard(shard):
+        note = db.session.get(Note, note_id)
+        note.content = text
+        note.version = note.version + 1
+        record_revision(note)
+        record_change(user_id, 'note.updated', note.id, fields={'content': text}, version=note.version)
+        db.session.commit()
+    return 200
+
+
+def worker(config, user_id, note_id, shard, direct, start, seconds, results):
+    from app import create_app
+
+    app = create_app(config)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    client.get('/changes') # Warm up: user loader, schema check, purge run
+
+    saved = failed = 0
+    start.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        text = f"autosave {saved}"
+        try:
+            if direct:
+                status = save_direct(app, user_id, note_id, shard, text)
+            else:
+                status = client.post(f"/update/{note_id}", json={'content': text}).status_code
+        except Exception:
+            status = 500
+        if status == 200: saved += 1
+        else: failed += 1
+    results.put((saved, failed))
+
+
+def run(shards, workers, seconds, folder, direct=False):
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        config = bench_config(tmp, shards)
+        notes = setup(config, workers)
+
+        ctx = multiprocessing.get_context('fork')
+        start, results = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(config, uid, nid, shard, direct, start, seconds, results))
+                 for uid, nid, shard in notes]
+        for p in procs: p.start()
+        time.sleep(1) # Let every worker finish warming up
+        start.set()
+        counts = [results.get() for _ in procs]
+        for p in procs: p.join()
+
+    saved = sum(c[0] for c in counts)
+    failed = sum(c[1] for c in counts)
+    busiest = max(Counter(shard for _, _, shard in notes).values()) # Users sharing the most loaded lock
+    return saved / seconds, failed, busiest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure write throughput per shard count.')
+    parser.add_argument('--shards', default='1,2,4,8', help='Shard counts to compare')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent users (one process each)')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--direct', action='store_true', help='Write through the models, skipping HTTP')
+    parser.add_argument('--dir', default=os.path.join(HERE, 'instance'), help='Where throwaway databases go')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, HERE)
+    os.chdir(HERE)
+    os.makedirs(args.dir, exist_ok=True)
+
+    mode = 'model writes' if args.direct else '/update requests'
+    print(f"{args.workers} concurrent users, {mode}, {args.seconds:g}s per run, {os.cpu_count()} CPUs")
+    print(f"{'shards':>6} {'saves/s':>9} {'speedup':>8} {'failed':>7} {'busiest':>8}")
+    baseline = None
+    for shards in [int(n) for n in args.shards.split(',')]:
+        rate, failed, busiest = run(shards, args.workers, args.seconds, args.dir, args.direct)
+        baseline = baseline or rate
+        print(f"{shards:>6} {rate:>9.1f} {rate / baseline:>7.2f}x {failed:>7} {busiest:>8}")
+
+
+if __name__ == '__main__':
+    main()
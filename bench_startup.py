@@ -0,0 +1,96 @@
+"""Worker start-up benchmark: import time and time-to-first-response.
+
+    python bench_startup.py --workers 4
+    python bench_startup.py --workers 4 --preload
+
+Cold mode starts every worker as a fresh interpreter (gunicorn without
+--preload). Preload mode imports and builds the app once, then forks
+workers the way `gunicorn --preload` does, so only first-request work is
+paid per worker. A throwaway SQLite file is used, never instance/app.db.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import app as app_module
+t1 = time.perf_counter()
+app = app_module.create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+t2 = time.perf_counter()
+status = app.test_client().get(sys.argv[2]).status_code
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'factory': t2 - t1, 'first_response': t3 - t2,
+                  'status': status, 'pillow_loaded': 'PIL' in sys.modules}))
+'''
+
+
+def run_cold(db_uri, path):
+    out = subprocess.run([sys.executable, '-c', CHILD, db_uri, path], cwd=HERE,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def run_preloaded(db_uri, path, workers):
+    sys.path.insert(0, HERE)
+    os.chdir(HERE)
+    t0 = time.perf_counter()
+    import app as app_module
+    t1 = time.perf_counter()
+    app = app_module.create_app({'SQLALCHEMY_DATABASE_URI': db_uri})
+    t2 = time.perf_counter()
+
+    results = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0: # Worker: only first-request work is left
+            os.close(read_fd)
+            start = time.perf_counter()
+            status = app.test_client().get(path).status_code
+            payload = {'import': 0.0, 'factory': 0.0, 'first_response': time.perf_counter() - start,
+                       'status': status, 'pillow_loaded': 'PIL' in sys.modules}
+            os.write(write_fd, json.dumps(payload).encode())
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            results.append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+
+    print(f"master: import {(t1 - t0) * 1000:.1f} ms, factory {(t2 - t1) * 1000:.1f} ms (paid once)")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure per-worker start-up cost.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--path', default='/', help='Route requested as the first response')
+    parser.add_argument('--preload', action='store_true', help='Fork from a preloaded master')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_uri = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        if args.preload:
+            results = run_preloaded(db_uri, args.path, args.workers)
+        else:
+            results = [run_cold(db_uri, args.path) for _ in range(args.workers)]
+
+    print(f"{'worker':>6} {'import ms':>10} {'factory ms':>11} {'first resp ms':>14} {'status':>7} {'pillow':>7}")
+    for i, r in enumerate(results, 1):
+        print(f"{i:>6} {r['import'] * 1000:>10.1f} {r['factory'] * 1000:>11.1f} "
+              f"{r['first_response'] * 1000:>14.1f} {r['status']:>7} {str(r['pillow_loaded']):>7}")
+
+    totals = [r['import'] + r['factory'] + r['first_response'] for r in results]
+    print(f"median time-to-first-response per worker: {statistics.median(totals) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from extensions import db
+from models import ChangeEvent
+
+# --- Change Feed ---
+# Every mutating route appends a ChangeEvent in the same transaction as the
+# edit itself, so a committed edit always has a matching event. Clients keep
+# the last event id they saw and either stream (SSE) or poll from there.
+
+CATCHUP_LIMIT = 500              # Max events per /changes response
+STREAM_POLL_SECONDS = 1.0        # How often an open stream checks the log
+STREAM_MAX_SECONDS = 25          # Close stream so a worker thread is not pinned for long; client resumes
+STREAM_RETRY_MS = 2000           # EventSource reconnect delay
+STREAM_SLOTS = 12                # Open streams per worker process; the rest of its threads serve everything else
+RETENTION = timedelta(days=7)    # Older events are pruned
+
+
+def record_change(user_id, kind, note_id=None, **data):
+    """Append an event to the user's log. Committed by the caller's db.session.commit()."""
+    event = ChangeEvent(
+        user_id=user_id,
+        note_id=note_id,
+        kind=kind,
+        payload=json.dumps(data),
+        created_at=datetime.now()
+    )
+    db.session.add(event)
+    return event
+
+
+def tag_dict(tag):
+    return {'id': tag.id, 'name': tag.name, 'color': tag.color}
+
+
+def latest_cursor():
+    # Global max id: ids are shared across users, so anything at or below it is
+    # already reflected in whatever the caller reads next.
+    return db.session.query(func.max(ChangeEvent.id)).scalar() or 0
+
+
+def changes_since(user_id, cursor, limit=CATCHUP_LIMIT):
+    """Return (events, reset) for a user after `cursor`.
+
+    `reset` is True when events the client never saw may already have been
+    pruned, in which case it has to reload instead of applying deltas.
+    """
+    oldest = db.session.query(func.min(ChangeEvent.id)).scalar()
+    if cursor and oldest is not None and cursor < oldest - 1:
+        return [], True
+
+    events = ChangeEvent.query.filter(ChangeEvent.user_id == user_id, ChangeEvent.id > cursor)\
+        .order_by(ChangeEvent.id).limit(limit).all()
+    return [e.to_dict() for e in events], False
+
+
+def prune_changes():
+    cutoff = datetime.now() - RETENTION
+    ChangeEvent.query.filter(ChangeEvent.created_at < cutoff).delete(synchronize_session=False)
+
+
+def parse_cursor(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# Each open stream holds one worker thread, so a worker only takes STREAM_SLOTS
+# of them; past that, clients are told to poll /changes instead.
+_slots_lock = threading.Lock()
+_open_streams = 0
+
+
+@contextmanager
+def stream_slot(limit=STREAM_SLOTS):
+    """Yields True if this worker has a free stream slot (held until the block ends)."""
+    global _open_streams
+    with _slots_lock:
+        granted = _open_streams < limit
+        if granted: _open_streams += 1
+    try:
+        yield granted
+    finally:
+        if granted:
+            with _slots_lock:
+                _open_streams -= 1
+
+
+def sse_stream(user_id, cursor):
+    """Generator of SSE frames for one connection (wrap with stream_with_context)."""
+    yield f"retry: {STREAM_RETRY_MS}\n\n"
+
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+    while True:
+        # Read the head first: anything committed after it gets a higher id
+        head = latest_cursor()
+        events, reset = changes_since(user_id, cursor)
+        if reset:
+            yield "event: reset\ndata: {}\n\n"
+            return
+
+        for event in events:
+            cursor = event['id']
+            yield f"id: {cursor}\ndata: {json.dumps(event)}\n\n"
+
+        if not events:
+            # Advance Last-Event-ID past other users' events so an idle client
+            # does not fall behind the retention window.
+            if head > cursor:
+                cursor = head
+                yield f"id: {cursor}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+
+        # End the read transaction so the next poll sees new commits
+        db.session.rollback()
+
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(STREAM_POLL_SECONDS)
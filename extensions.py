@@ -1,5 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
-db = SQLAlchemy()
+from sharding import ShardedSession
+
+db = SQLAlchemy(session_options={'class_': ShardedSession})
 login_manager = LoginManager()
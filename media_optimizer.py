@@ -0,0 +1,272 @@
+"""Shrink uploaded originals: apply EXIF orientation, strip metadata, cap the
+longest side and re-encode to progressive JPEG / WebP when that is smaller.
+
+Used at ingest (OPTIMIZE_UPLOADS) and as a batch tool for existing files:
+
+    python media_optimizer.py --dry-run
+    python media_optimizer.py --max-side 2048 --workers 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_MAX_SIDE = 2048
+DEFAULT_QUALITY = 82
+DEFAULT_FORMATS = ('jpeg', 'webp')
+JOURNAL_PATH = os.path.join('instance', 'optimize_uploads.journal')
+
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+SOURCE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'} # GIFs are skipped (animation)
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'icc_profile')
+SOURCE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+
+
+def _has_alpha(img):
+    return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def _has_metadata(img):
+    return bool(img.getexif()) or any(key in img.info for key in METADATA_KEYS)
+
+
+def _encode(img, fmt, quality):
+    buf = io.BytesIO()
+    if fmt == 'JPEG':
+        if img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+        img.save(buf, 'JPEG', quality=quality, optimize=True, progressive=True)
+    elif fmt == 'WEBP':
+        img.save(buf, 'WEBP', quality=quality, method=6)
+    else:
+        img.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+
+def _target_path(path, fmt):
+    stem, ext = os.path.splitext(path)
+    if ext.lower() in ('.jpg', '.jpeg') and fmt == 'JPEG':
+        return path # Keep name, references stay valid
+    if ext.lower() == EXTENSIONS[fmt]:
+        return path
+    return stem + EXTENSIONS[fmt]
+
+
+def optimize_file(path, max_side=DEFAULT_MAX_SIDE, quality=DEFAULT_QUALITY,
+                  formats=DEFAULT_FORMATS, dry_run=False):
+    """Optimize one image in place. Returns a result dict.
+
+    `new_path` differs from `path` when the format changed; the original is
+    left on disk so the caller can delete it once references are updated.
+    """
+    from PIL import Image, ImageOps # Deferred so importing the web app stays cheap
+
+    before = os.path.getsize(path)
+    result = {'path': path, 'new_path': path, 'before': before, 'after': before, 'changed': False}
+
+    with Image.open(path) as img:
+        if getattr(img, 'is_animated', False):
+            result['skipped'] = 'animated'
+            return result
+
+        has_metadata = _has_metadata(img)
+        img = ImageOps.exif_transpose(img) # Bakes orientation in, drops the tag
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        source_fmt = 'JPEG' if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg') else None
+        candidates = set(f.upper() for f in formats)
+        if _has_alpha(img):
+            candidates.discard('JPEG')
+            candidates.add('PNG')
+        if source_fmt:
+            candidates.add(source_fmt) # Same-name re-encode is always an option
+
+        # Saving without exif=/icc_profile= strips the metadata
+        best_fmt, best_data = None, None
+        for fmt in sorted(candidates):
+            data = _encode(img, fmt, quality)
+            if best_data is None or len(data) < len(best_data):
+                best_fmt, best_data = fmt, data
+
+        if (best_data is None or len(best_data) >= before) and has_metadata:
+            # No smaller encoding, but EXIF/GPS must still go: rewrite in the source format
+            best_fmt = SOURCE_FORMATS[os.path.splitext(path)[1].lower()]
+            best_data = _encode(img, best_fmt, quality)
+            result['stripped'] = True
+
+    if best_data is None or (len(best_data) >= before and not result.get('stripped')):
+        result['skipped'] = 'no saving'
+        return result
+
+    new_path = _target_path(path, best_fmt)
+    if new_path != path and os.path.exists(new_path):
+        stem, ext = os.path.splitext(new_path)
+        new_path = f"{stem}_opt{ext}"
+
+    result.update({'new_path': new_path, 'after': len(best_data), 'changed': True})
+    if not dry_run:
+        tmp_path = new_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(best_data)
+        os.replace(tmp_path, new_path) # Atomic: never a half-written upload
+    return result
+
+
+def _worker(args):
+    path, options = args
+    try:
+        return optimize_file(path, **options)
+    except Exception as e:
+        return {'path': path, 'new_path': path, 'changed': False, 'error': str(e)}
+
+
+def _upload_url(path):
+    return f"/static/uploads/{os.path.basename(path)}"
+
+
+def update_references(renames):
+    """Point Note.media_json at renamed files. Idempotent, so safe to re-run on resume."""
+    from app import create_app, init_schema
+    from extensions import db
+    from models import Note
+    from sharding import all_shards, using_shard
+
+    if not renames:
+        return 0
+
+    app = create_app()
+    init_schema(app) # The ORM reads every column, so bring older databases up to date first
+    url_map = {_upload_url(old): _upload_url(new) for old, new in renames.items()}
+    updated = 0
+    with app.app_context():
+        for shard in all_shards():
+            with using_shard(shard):
+                for note in Note.query.filter(Note.media_json.like('%/uploads/%')).all():
+                    try:
+                        media = json.loads(note.media_json)
+                    except:
+                        continue
+                    dirty = False
+                    for m in media:
+                        for key in ('url', 'thumbnail_url', 'duplicate_of'):
+                            if m.get(key) in url_map:
+                                m[key] = url_map[m[key]]
+                                dirty = True
+                    if dirty:
+                        note.media_json = json.dumps(media)
+                        updated += 1
+                db.session.commit()
+    return updated
+
+
+def _load_journal(path):
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # Torn last line from an interrupt
+                done[entry['path']] = entry
+    return done
+
+
+def _history_path(journal_path):
+    # Outputs of completed runs; the journal itself only tracks the run in progress
+    return os.path.splitext(journal_path)[0] + '.done'
+
+
+def _load_history(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Optimize existing uploads in place.')
+    parser.add_argument('--folder', default=os.path.join('static', 'uploads'))
+    parser.add_argument('--max-side', type=int, default=DEFAULT_MAX_SIDE, help='Longest side cap in pixels')
+    parser.add_argument('--quality', type=int, default=DEFAULT_QUALITY)
+    parser.add_argument('--formats', default=','.join(DEFAULT_FORMATS), help='Candidate output formats')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--journal', default=JOURNAL_PATH, help='Progress file used to resume')
+    parser.add_argument('--dry-run', action='store_true', help='Report savings without writing')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    options = {
+        'max_side': args.max_side,
+        'quality': args.quality,
+        'formats': tuple(f.strip() for f in args.formats.split(',') if f.strip()),
+        'dry_run': args.dry_run,
+    }
+
+    history_path = _history_path(args.journal)
+    history = _load_history(history_path) # Never re-encoded: no second lossy pass
+    done = {} if args.dry_run else _load_journal(args.journal) # Interrupted run being resumed
+    paths = sorted(
+        os.path.join(args.folder, name) for name in os.listdir(args.folder)
+        if not name.startswith('thumb_') # Already small, regenerated at ingest
+        and os.path.splitext(name)[1].lower() in SOURCE_EXTENSIONS
+    )
+    # Files written earlier in this run are done too
+    outputs = {entry['new_path'] for entry in done.values()}
+    earlier = [p for p in paths if p in history]
+    todo = [p for p in paths if p not in history and p not in done and p not in outputs]
+    print(f"{len(paths)} uploads, {len(earlier)} done by earlier runs, "
+          f"{len(paths) - len(earlier) - len(todo)} resumed, {len(todo)} to process")
+
+    results = list(done.values())
+    journal = None if args.dry_run else open(args.journal, 'a')
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for result in pool.map(_worker, [(p, options) for p in todo], chunksize=4):
+                results.append(result)
+                if journal and 'error' not in result:
+                    journal.write(json.dumps(result) + '\n')
+                    journal.flush()
+                if args.verbose or 'error' in result:
+                    status = result.get('error') or result.get('skipped') or f"{result['before']} -> {result['after']}"
+                    print(f"  {os.path.basename(result['path'])}: {status}")
+    finally:
+        if journal: journal.close()
+
+    renames = {r['path']: r['new_path'] for r in results if r.get('changed') and r['new_path'] != r['path']}
+    if not args.dry_run:
+        notes = update_references(renames)
+        # Originals go only after references point at the new files
+        for old in renames:
+            if os.path.exists(old): os.remove(old)
+        if renames: print(f"Updated media references in {notes} notes")
+
+    changed = [r for r in results if r.get('changed')]
+    errors = [r for r in results if 'error' in r]
+    if not args.dry_run and not errors:
+        # Run complete: move its outputs to the history and start the next run with an empty journal
+        with open(history_path, 'a') as f:
+            for r in results:
+                f.write(r['new_path'] + '\n')
+        if os.path.exists(args.journal): os.remove(args.journal)
+    before = sum(r['before'] for r in changed)
+    after = sum(r['after'] for r in changed)
+    stripped = sum(1 for r in changed if r.get('stripped'))
+    print(f"{'Would optimize' if args.dry_run else 'Optimized'} {len(changed)} files "
+          f"({len(renames)} re-encoded to a new format, {stripped} only stripped of metadata), {len(errors)} errors")
+    print(f"Total bytes saved: {before - after} ({_format_bytes(before)} -> {_format_bytes(after)})")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
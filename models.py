@@ -1,5 +1,7 @@
 from flask_login import UserMixin
+from sqlalchemy import event
 from extensions import db
+from sharding import sequence_id, shard_count
 from datetime import datetime
 import json
 
@@ -9,6 +11,8 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     name = db.Column(db.String(150), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Database shard holding this user's notes/tags (None = main database), see sharding.py
+    shard = db.Column(db.Integer, nullable=True)
     
     # Relationship
     notes = db.relationship('Note', backref='user', lazy=True)
@@ -16,6 +20,12 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f"<User {self.id} {self.email}>"
 
+# Id source for notes and tags once sharding is on (main database only), see sharding.py
+id_sequence = db.Table('id_sequence',
+    db.Column('id', db.Integer, primary_key=True),
+    sqlite_autoincrement=True
+)
+
 # Many-to-Many Helper Table
 note_tags = db.Table('note_tags',
     db.Column('note_id', db.Integer, db.ForeignKey('note.id'), primary_key=True),
@@ -51,9 +61,59 @@ class Note(db.Model):
     # Lifecycle
     deleted_at = db.Column(db.DateTime, nullable=True)
 
+    # Content version: bumped on every content save, base for autosave patches
+    version = db.Column(db.Integer, default=1, nullable=False)
+
     # Tags Relationship
     tags = db.relationship('Tag', secondary=note_tags, lazy='subquery',
         backref=db.backref('notes', lazy=True))
 
     def __repr__(self):
         return f"<Note {self.id} user={self.user_id}>"
+
+class ChangeEvent(db.Model):
+    # Append-only per-user change log. The autoincrement id doubles as the
+    # sync cursor (SSE Last-Event-ID), so ids must never be reused.
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    note_id = db.Column(db.Integer, nullable=True) # No FK: survives permanent deletes
+
+    # e.g. 'note.created', 'note.updated', 'note.tags', 'tag.created'
+    kind = db.Column(db.String(32), nullable=False)
+    # JSON String: event specific fields
+    payload = db.Column(db.Text, default='{}')
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def to_dict(self):
+        try:
+            data = json.loads(self.payload or '{}')
+        except:
+            data = {}
+        return {'id': self.id, 'kind': self.kind, 'note_id': self.note_id, 'data': data}
+
+    def __repr__(self):
+        return f"<ChangeEvent {self.id} user={self.user_id} {self.kind}>"
+
+class NoteRevision(db.Model):
+    # Bounded content history: 'patch' rows hold the ops that produced
+    # `version`, 'snapshot' rows the full content at `version`.
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text) # JSON ops list or full content
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<NoteRevision note={self.note_id} v{self.version} {self.kind}>"
+
+@event.listens_for(Note, 'before_insert')
+@event.listens_for(Tag, 'before_insert')
+def assign_global_id(mapper, connection, target):
+    # Shards would otherwise each count from 1, and a moved user's ids would clash
+    if target.id is None and shard_count():
+        target.id = sequence_id(db, connection)
@@ -0,0 +1,405 @@
+"""Find near-duplicate images: the same photo re-uploaded, re-exported or
+re-compressed, which byte-for-byte comparison misses.
+
+Every image gets a 64-bit difference hash (dHash) of its thumbnail, stored
+as `phash` on its media item. Two images whose hashes differ in only a few
+bits look the same. Used at ingest (DUPLICATE_UPLOADS) and as a batch tool:
+
+    python perceptual_hash.py                 # report near-duplicate groups
+    python perceptual_hash.py --distance 4 -v
+    python perceptual_hash.py --backfill      # store hashes on existing media items
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+HASH_WIDTH, HASH_HEIGHT = 9, 8   # 9 columns -> 8 left/right comparisons per row = 64 bits
+SAMPLE = 4                       # Pillow shrinks to 4x that, NumPy averages the blocks
+DEFAULT_DISTANCE = 6             # Max differing bits still called a duplicate
+MERGE_DISTANCE = 0               # Stricter for merging: edits and burst shots land at 2-5 bits
+SOURCE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.gif'}
+PAIRS_PER_BLOCK = 4 * 1024 * 1024 # Hash pairs compared at once by near_pairs (~70 MB peak)
+
+INDEX_TTL = 60                   # Seconds before a worker re-reads a user's hashes
+MAX_USERS = 256                  # Indexes kept per process (LRU)
+
+_lock = threading.Lock()
+_indexes = OrderedDict()         # (user_id, shard) -> BKTree
+
+
+# --- Hashing ---
+
+def _small_gray(img):
+    from PIL import Image
+
+    # JPEG decodes straight at 1/2..1/8 scale, which is most of the batch speed-up
+    img.draft('L', (HASH_WIDTH * SAMPLE * 2, HASH_HEIGHT * SAMPLE * 2))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA') # Transparent areas hash as white, not black
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        img = Image.alpha_composite(background, img)
+    return img.convert('L').resize((HASH_WIDTH * SAMPLE, HASH_HEIGHT * SAMPLE), Image.BOX)
+
+
+def dhash_batch(images):
+    """64-bit dHash for each PIL image, computed together as one NumPy array."""
+    import numpy as np
+
+    if not images:
+        return []
+    pixels = np.stack([np.asarray(_small_gray(img), dtype=np.float32) for img in images])
+    blocks = pixels.reshape(len(images), HASH_HEIGHT, SAMPLE, HASH_WIDTH, SAMPLE).mean(axis=(2, 4))
+    bits = blocks[:, :, 1:] > blocks[:, :, :-1]                 # (n, 8, 8): brighter than left neighbour
+    packed = np.packbits(bits.reshape(len(images), 64), axis=1)  # (n, 8) bytes, big-endian order
+    return [int(h) for h in packed.view('>u8').ravel()]
+
+
+def dhash(img):
+    return dhash_batch([img])[0]
+
+
+def to_hex(value):
+    return f"{value:016x}"
+
+
+def from_hex(text):
+    try:
+        return int(text, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def featureless(value):
+    # Blank canvases and solid fills have no gradient at all, so they would all "match"
+    return value == 0
+
+
+# --- Index ---
+
+class BKTree:
+    """Hamming-distance index: a lookup only walks children whose edge
+    distance can still be within the radius (triangle inequality)."""
+
+    def __init__(self):
+        self.root = None # [hash, items, {distance: child}]
+        self.size = 0
+        self.built_at = time.monotonic()
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """[(distance, item)] within `radius` bits, nearest first."""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, items, children = stack.pop()
+            d = hamming(value, node_value)
+            if d <= radius:
+                found.extend((d, item) for item in items)
+            for edge, child in children.items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        found.sort(key=lambda f: f[0])
+        return found
+
+
+def _load(user_id):
+    from extensions import db
+    from models import Note
+
+    tree = BKTree()
+    rows = db.session.query(Note.id, Note.media_json).filter(Note.user_id == user_id).all()
+    for note_id, media_json in rows:
+        try:
+            media = json.loads(media_json)
+        except:
+            continue
+        for m in media:
+            value = from_hex(m.get('phash'))
+            if value is not None and not featureless(value):
+                tree.add(value, {'note_id': note_id, 'id': m.get('id'), 'url': m.get('url'),
+                                 'thumbnail_url': m.get('thumbnail_url')})
+    return tree
+
+
+def _key(user_id):
+    # A user moved to another shard starts from a fresh index
+    from sharding import current_shard
+    return user_id, current_shard()
+
+
+def get_index(user_id):
+    key = _key(user_id)
+    with _lock:
+        index = _indexes.get(key)
+        if index and time.monotonic() - index.built_at < INDEX_TTL:
+            _indexes.move_to_end(key)
+            return index
+
+    index = _load(user_id)
+    with _lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def find_duplicate(user_id, value, distance=DEFAULT_DISTANCE):
+    """(bits, media item) of the user's closest earlier image within `distance`, or None."""
+    if featureless(value):
+        return None
+    matches = get_index(user_id).search(value, distance)
+    return matches[0] if matches else None
+
+
+def media_added(user_id, note_id, item):
+    # Keep this worker's index current; other workers pick it up after INDEX_TTL
+    value = from_hex(item.get('phash'))
+    with _lock:
+        index = _indexes.get(_key(user_id))
+    if index and value is not None and not featureless(value):
+        index.add(value, {'note_id': note_id, 'id': item['id'], 'url': item['url'],
+                          'thumbnail_url': item.get('thumbnail_url')})
+
+
+def same_image(path, other):
+    """True when both files hold the same picture: identical bytes or identical decoded pixels.
+
+    A matching dHash only says the 9x8 thumbnails look alike (screenshots of the
+    same screen often do), so this is checked before one upload replaces another.
+    """
+    if not os.path.exists(other):
+        return False
+    if os.path.getsize(path) == os.path.getsize(other) and _digest(path) == _digest(other):
+        return True
+
+    import numpy as np
+    from PIL import Image, ImageOps
+    with Image.open(path) as a, Image.open(other) as b:
+        a, b = ImageOps.exif_transpose(a), ImageOps.exif_transpose(b)
+        if a.size != b.size:
+            return False
+        return np.array_equal(np.asarray(a.convert('RGBA')), np.asarray(b.convert('RGBA')))
+
+
+# --- Batch Report ---
+
+def _hash_source(folder, name):
+    # The thumbnail is what ingest hashes; originals without one are decoded at reduced size
+    thumb = os.path.join(folder, 'thumb_' + name)
+    return thumb if os.path.exists(thumb) else os.path.join(folder, name)
+
+
+def _hash_chunk(paths):
+    from PIL import Image
+
+    images, ok, errors = [], [], {}
+    for path in paths:
+        try:
+            with Image.open(path) as img:
+                images.append(_small_gray(img))
+            ok.append(path)
+        except Exception as e:
+            errors[path] = str(e)
+    hashes = dict(zip(ok, dhash_batch(images)))
+    return hashes, errors
+
+
+def _digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).digest()
+
+
+def hash_files(sources, workers=None):
+    """{source path: hash} for many files, decoded in parallel chunks.
+
+    Byte-identical files (the same upload saved again) are decoded once.
+    """
+    copies = defaultdict(list)
+    for path in set(sources):
+        copies[_digest(path)].append(path)
+    paths = sorted(group[0] for group in copies.values())
+    chunks = [paths[i:i + 64] for i in range(0, len(paths), 64)]
+    hashes, errors = {}, {}
+    if workers == 1 or len(chunks) <= 1:
+        for chunk_hashes, chunk_errors in map(_hash_chunk, chunks):
+            hashes.update(chunk_hashes)
+            errors.update(chunk_errors)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk_hashes, chunk_errors in pool.map(_hash_chunk, chunks):
+                hashes.update(chunk_hashes)
+                errors.update(chunk_errors)
+
+    for group in copies.values():
+        first = group[0]
+        for path in group[1:]:
+            if first in hashes: hashes[path] = hashes[first]
+            if first in errors: errors[path] = errors[first]
+    return hashes, errors
+
+
+def _popcount(xor):
+    # Set bits per uint64, without expanding each pair to 64 bytes
+    import numpy as np
+
+    if hasattr(np, 'bitwise_count'): # NumPy >= 2.0
+        return np.bitwise_count(xor)
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def near_pairs(values, distance, block=1024):
+    """All (i, j) with i < j whose hashes are within `distance` bits, vectorized in blocks."""
+    import numpy as np
+
+    hashes = np.array(values, dtype=np.uint64)
+    detail = hashes != 0 # See featureless()
+    block = max(1, min(block, PAIRS_PER_BLOCK // max(len(hashes), 1))) # Bounded memory for big libraries
+    pairs = []
+    for start in range(0, len(hashes), block):
+        rows = hashes[start:start + block]
+        xor = rows[:, None] ^ hashes[None, :]                         # (block, n)
+        counts = _popcount(xor)
+        i, j = np.nonzero((counts <= distance) & detail[start:start + block, None] & detail[None, :])
+        i = i + start
+        keep = i < j
+        pairs.extend(zip(i[keep].tolist(), j[keep].tolist()))
+    return pairs
+
+
+def group_duplicates(values, distance):
+    """Connected groups (lists of indexes) of near-identical hashes, singletons left out."""
+    parent = list(range(len(values)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in near_pairs(values, distance):
+        parent[find(i)] = find(j)
+
+    groups = defaultdict(list)
+    for i in range(len(values)):
+        groups[find(i)].append(i)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def backfill(hashes_by_name):
+    """Store `phash` on every image media item that lacks one. Returns notes updated."""
+    from app import create_app, init_schema
+    from extensions import db
+    from models import Note
+    from sharding import all_shards, using_shard
+
+    app = create_app()
+    init_schema(app) # The ORM reads every column, so bring older databases up to date first
+    updated = 0
+    with app.app_context():
+        for shard in all_shards():
+            with using_shard(shard):
+                for note in Note.query.filter(Note.media_json.like('%/uploads/%')).all():
+                    try:
+                        media = json.loads(note.media_json)
+                    except:
+                        continue
+                    dirty = False
+                    for m in media:
+                        name = os.path.basename(m.get('url') or '')
+                        if m.get('type') == 'image' and 'phash' not in m and name in hashes_by_name:
+                            m['phash'] = to_hex(hashes_by_name[name])
+                            dirty = True
+                    if dirty:
+                        note.media_json = json.dumps(media)
+                        updated += 1
+                db.session.commit()
+    return updated
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024: return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report near-duplicate uploads.')
+    parser.add_argument('--folder', default=os.path.join('static', 'uploads'))
+    parser.add_argument('--distance', type=int, default=DEFAULT_DISTANCE, help='Max differing bits (of 64)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--backfill', action='store_true', help='Store hashes on media items that lack one')
+    parser.add_argument('-v', '--verbose', action='store_true', help='List every group')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    names = sorted(
+        name for name in os.listdir(args.folder)
+        if not name.startswith('thumb_') and os.path.splitext(name)[1].lower() in SOURCE_EXTENSIONS
+    )
+    sources = {name: _hash_source(args.folder, name) for name in names}
+    hashes, errors = hash_files(sources.values(), args.workers)
+    by_name = {name: hashes[src] for name, src in sources.items() if src in hashes}
+    hashed = time.perf_counter()
+
+    names = sorted(by_name)
+    groups = group_duplicates([by_name[n] for n in names], args.distance)
+    sizes = {n: os.path.getsize(os.path.join(args.folder, n)) for n in names}
+
+    report = []
+    for group in groups:
+        files = sorted((names[i] for i in group), key=lambda n: -sizes[n])
+        # Keeping the largest copy, everything else is reclaimable
+        report.append({'keep': files[0], 'copies': files[1:], 'bytes': sum(sizes[n] for n in files[1:])})
+    report.sort(key=lambda g: -g['bytes'])
+
+    for path, error in errors.items():
+        print(f"  {os.path.basename(path)}: {error}")
+    for group in report if args.verbose else report[:10]:
+        print(f"{len(group['copies']) + 1} copies, {_format_bytes(group['bytes'])} reclaimable: {group['keep']}")
+        if args.verbose:
+            for name in group['copies']: print(f"    {name}")
+    if not args.verbose and len(report) > 10:
+        print(f"... {len(report) - 10} more groups (-v lists all)")
+
+    duplicates = sum(len(g['copies']) for g in report)
+    print(f"{len(by_name)} images hashed in {hashed - started:.2f}s, {len(errors)} errors")
+    print(f"{len(report)} near-duplicate groups (<= {args.distance} bits), {duplicates} redundant copies, "
+          f"{_format_bytes(sum(g['bytes'] for g in report))} reclaimable")
+
+    if args.backfill:
+        print(f"Stored hashes in {backfill(by_name)} notes")
+    print(f"Done in {time.perf_counter() - started:.2f}s")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request
+from flask_login import current_user
+from sqlalchemy import event
+
+from extensions import db
+
+# --- On-demand Request Profiler ---
+# A profiled request gets a sampler thread that reads the request thread's
+# stack every PROFILE_INTERVAL seconds (statistical, so the request itself
+# runs unmodified) plus a timeline of the SQL it ran. Output per request:
+#   <id>.collapsed  "frame;frame;frame count" lines (flamegraph.pl, speedscope)
+#   <id>.json       request info + SQL timeline
+# Triggered by an `X-Profile: <PROFILE_SECRET>` header, by an admin
+# (PROFILE_ADMINS emails) adding ?profile=1, or at random (PROFILE_SAMPLE_RATE).
+
+MAX_STACK_DEPTH = 128
+MAX_SQL_LENGTH = 500
+
+
+class RequestProfile:
+    def __init__(self, thread_id, interval, max_seconds):
+        # Sorts chronologically, which is what rotation relies on
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{uuid.uuid4().hex[:6]}"
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = Counter()
+        self.sql = []
+        self.started = time.perf_counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return time.perf_counter() - self.started
+
+    def _sample(self):
+        deadline = self.started + self.max_seconds
+        while not self._stop.wait(self.interval) and time.perf_counter() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def offset_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+
+def _wants_profile(app):
+    secret = app.config['PROFILE_SECRET']
+    # Constant-time compare so response timing doesn't leak the secret
+    if secret and hmac.compare_digest(request.headers.get('X-Profile', '').encode(), secret.encode()):
+        return True
+    if request.args.get('profile') == '1' and current_user.is_authenticated \
+            and current_user.email in app.config['PROFILE_ADMINS']:
+        return True
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def _rotate(folder, keep):
+    # Oldest profiles go first; both files of a profile share the id
+    ids = sorted({name.rsplit('.', 1)[0] for name in os.listdir(folder)})
+    for old in ids[:max(len(ids) - keep, 0)]:
+        for ext in ('.collapsed', '.json'):
+            path = os.path.join(folder, old + ext)
+            if os.path.exists(path): os.remove(path)
+
+
+def _save(app, profile, duration, status):
+    folder = app.config['PROFILE_DIR']
+    os.makedirs(folder, exist_ok=True)
+
+    with open(os.path.join(folder, profile.id + '.collapsed'), 'w') as f:
+        for stack, count in profile.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    with open(os.path.join(folder, profile.id + '.json'), 'w') as f:
+        json.dump({
+            'id': profile.id,
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': status,
+            'user_id': current_user.get_id(),
+            'duration_ms': round(duration * 1000, 2),
+            'interval_ms': profile.interval * 1000,
+            'samples': sum(profile.stacks.values()),
+            'sql_ms': round(sum(q['duration_ms'] for q in profile.sql), 2),
+            'sql': profile.sql,
+        }, f, indent=1)
+
+    _rotate(folder, app.config['PROFILE_KEEP'])
+
+
+def init_profiling(app):
+    app.config.setdefault('PROFILE_SECRET', os.environ.get('PROFILE_SECRET', ''))
+    app.config.setdefault('PROFILE_ADMINS', {e.strip() for e in os.environ.get('PROFILE_ADMINS', '').split(',') if e.strip()})
+    app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', '0')))
+    app.config.setdefault('PROFILE_INTERVAL', float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000)
+    app.config.setdefault('PROFILE_MAX_SECONDS', 30) # Cap for long streams
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+    app.config.setdefault('PROFILE_KEEP', 200)       # Profiles kept on disk
+
+    sql_listeners = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = g.get('profile') if g else None
+        if profile: conn.info.setdefault('profile_sql_start', []).append(profile.offset_ms())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = g.get('profile') if g else None
+        starts = conn.info.get('profile_sql_start')
+        if profile and starts:
+            start = starts.pop()
+            profile.sql.append({
+                'start_ms': round(start, 3),
+                'duration_ms': round(profile.offset_ms() - start, 3),
+                'statement': statement[:MAX_SQL_LENGTH],
+            })
+
+    @app.before_request
+    def start_profile():
+        if not _wants_profile(app):
+            return
+        if not sql_listeners:
+            # Engines only exist inside an app context, so hook them on first use (main + shards)
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+                sql_listeners.append(engine)
+        g.profile = RequestProfile(threading.get_ident(), app.config['PROFILE_INTERVAL'], app.config['PROFILE_MAX_SECONDS'])
+        g.profile.start()
+
+    @app.after_request
+    def tag_response(response):
+        profile = g.get('profile')
+        if profile:
+            response.headers['X-Profile-Id'] = profile.id
+            g.profile_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_profile(exc):
+        profile = g.pop('profile', None)
+        if not profile:
+            return
+        duration = profile.stop()
+        try:
+            _save(app, profile, duration, g.get('profile_status', 500))
+        except OSError as e:
+            app.logger.warning(f"Profile not saved: {e}")
@@ -0,0 +1,206 @@
+"""Move users' notes between the main database and per-user shards.
+
+Shard count comes from DB_SHARDS (same as the app). Moving from a single
+app.db is just a rebalance after raising it:
+
+    DB_SHARDS=4 python shard_tool.py status
+    DB_SHARDS=4 python shard_tool.py rebalance --dry-run
+    DB_SHARDS=4 python shard_tool.py rebalance
+    DB_SHARDS=4 python shard_tool.py move 12 3     # or 'main'
+"""
+import argparse
+import os
+import sys
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select, update
+
+from app import create_app, init_schema
+from extensions import db
+from sharding import MAIN, default_shard, shard_binds, shard_engine
+
+
+def _databases():
+    # Configured shards plus any beyond DB_SHARDS that users still live on
+    return [MAIN] + sorted(int(key.rsplit('_', 1)[1]) for key in db.engines if key)
+
+
+def _label(shard):
+    return 'main' if shard is MAIN else f"shard {shard}"
+
+
+def _user_rows(conn, tables, user_id):
+    note, tag, links, revisions = tables['note'], tables['tag'], tables['note_tags'], tables['note_revision']
+    notes = conn.execute(select(note).where(note.c.user_id == user_id)).mappings().all()
+    note_ids = select(note.c.id).where(note.c.user_id == user_id)
+    return {
+        'note': notes,
+        'tag': conn.execute(select(tag).where(tag.c.user_id == user_id)).mappings().all(),
+        'note_tags': conn.execute(select(links).where(links.c.note_id.in_(note_ids))).mappings().all(),
+        'note_revision': conn.execute(select(revisions).where(revisions.c.note_id.in_(note_ids))).mappings().all(),
+    }
+
+
+def _delete_user_rows(conn, tables, user_id):
+    note = tables['note']
+    note_ids = select(note.c.id).where(note.c.user_id == user_id)
+    conn.execute(delete(tables['note_tags']).where(tables['note_tags'].c.note_id.in_(note_ids)))
+    conn.execute(delete(tables['note_revision']).where(tables['note_revision'].c.note_id.in_(note_ids)))
+    conn.execute(delete(tables['change_event']).where(tables['change_event'].c.user_id == user_id))
+    conn.execute(delete(note).where(note.c.user_id == user_id))
+    conn.execute(delete(tables['tag']).where(tables['tag'].c.user_id == user_id))
+
+
+def _copy_rows(conn, tables, rows):
+    # Note and tag ids are unique across databases (sharding.sequence_id), so they
+    # are kept: open tabs and links keep pointing at the same notes
+    for table in ('note', 'tag'):
+        if rows[table]:
+            conn.execute(insert(tables[table]), [dict(row) for row in rows[table]])
+
+    tag_ids = {row['id'] for row in rows['tag']}
+    links = [dict(r) for r in rows['note_tags'] if r['tag_id'] in tag_ids]
+    if links:
+        conn.execute(insert(tables['note_tags']), links)
+
+    # Nothing refers to revision ids, so they are renumbered
+    revisions = [{k: v for k, v in row.items() if k != 'id'} for row in rows['note_revision']]
+    if revisions:
+        conn.execute(insert(tables['note_revision']), revisions)
+    # Change events stay behind: open clients see the shard change and reload
+
+
+def move_user(user_id, source, target):
+    """Copy a user's rows from `source` to `target`, repoint the user, then delete the originals.
+
+    The source database stays write-locked for the whole move and user.shard
+    is repointed before that lock is released. A request that routed to the
+    source before the move and writes after it gets its commit refused
+    (sharding.ShardMoved, a 503 to the client) instead of writing rows that
+    `sweep` would delete. Safe to re-run after a crash: leftovers in the target
+    are cleared before copying, and `sweep` removes leftovers in the source.
+    """
+    tables = db.metadata.tables
+    flip = update(tables['user']).where(tables['user'].c.id == user_id).values(shard=target)
+
+    with shard_engine(source, db).connect() as src:
+        src.exec_driver_sql('BEGIN IMMEDIATE')
+        rows = _user_rows(src, tables, user_id)
+
+        with shard_engine(target, db).begin() as dst:
+            _delete_user_rows(dst, tables, user_id)
+            _copy_rows(dst, tables, rows)
+
+        if source is MAIN:
+            src.execute(flip) # Same transaction as the delete below
+        else:
+            with db.engine.begin() as main:
+                main.execute(flip)
+
+        _delete_user_rows(src, tables, user_id)
+        src.commit()
+    return len(rows['note'])
+
+
+def sweep(homes):
+    """Delete rows left in databases that are not their user's home. Returns the number of users cleaned."""
+    tables = db.metadata.tables
+    removed = 0
+    for shard in _databases():
+        with shard_engine(shard, db).begin() as conn:
+            owners = {uid for (uid,) in conn.execute(select(tables['note'].c.user_id).distinct())}
+            owners |= {uid for (uid,) in conn.execute(select(tables['tag'].c.user_id).distinct())}
+            for user_id in owners:
+                if user_id in homes and homes[user_id] != shard:
+                    _delete_user_rows(conn, tables, user_id)
+                    removed += 1
+    return removed
+
+
+def _homes():
+    user = db.metadata.tables['user']
+    with db.engine.connect() as conn:
+        return {uid: shard for uid, shard in conn.execute(select(user.c.id, user.c.shard))}
+
+
+def cmd_status(args):
+    homes = _homes()
+    note = db.metadata.tables['note']
+    for shard in _databases():
+        engine = shard_engine(shard, db)
+        with engine.connect() as conn:
+            notes = conn.execute(select(func.count()).select_from(note)).scalar()
+        users = sum(1 for home in homes.values() if home == shard)
+        path = engine.url.database
+        size = os.path.getsize(path) if path and os.path.exists(path) else 0
+        print(f"{_label(shard):>10}: {users} users, {notes} notes, {size / 1024:.0f} KB  ({path})")
+    misplaced = sum(1 for uid, home in homes.items() if home != default_shard(uid))
+    print(f"{misplaced} of {len(homes)} users not on their default shard")
+    return 0
+
+
+def cmd_rebalance(args):
+    homes = _homes()
+    moves = [(uid, home, default_shard(uid)) for uid, home in sorted(homes.items()) if home != default_shard(uid)]
+    print(f"{len(moves)} of {len(homes)} users to move")
+    for user_id, source, target in moves:
+        if args.dry_run:
+            print(f"  user {user_id}: {_label(source)} -> {_label(target)}")
+            continue
+        notes = move_user(user_id, source, target)
+        print(f"  user {user_id}: {_label(source)} -> {_label(target)} ({notes} notes)")
+    if not args.dry_run:
+        print(f"Removed leftovers of {sweep(_homes())} users")
+    return 0
+
+
+def cmd_move(args):
+    homes = _homes()
+    if args.user_id not in homes:
+        print(f"No user {args.user_id}")
+        return 1
+    target = MAIN if args.shard == 'main' else int(args.shard)
+    if target is not MAIN and target >= current_app.config['DB_SHARDS']:
+        print(f"No {_label(target)} (DB_SHARDS={current_app.config['DB_SHARDS']})")
+        return 1
+    source = homes[args.user_id]
+    if source == target:
+        print(f"User {args.user_id} is already on {_label(target)}")
+        return 0
+    notes = move_user(args.user_id, source, target)
+    print(f"Moved user {args.user_id}: {_label(source)} -> {_label(target)} ({notes} notes)")
+    return 0
+
+
+def _open_app():
+    app = create_app()
+    init_schema(app) # Creates shard files and the user.shard column
+    with app.app_context():
+        highest = max((s for s in _homes().values() if s is not None), default=-1)
+    if highest < app.config['DB_SHARDS']:
+        return app
+
+    # DB_SHARDS was lowered: open the old shards too so their users can be moved back
+    old = shard_binds(highest + 1, app.config['SHARD_URI_TEMPLATE'])
+    extra = {key: uri for key, uri in old.items() if key not in app.config['SQLALCHEMY_BINDS']}
+    return create_app({'SQLALCHEMY_BINDS': extra})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and rebalance per-user database shards.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='Users and notes per database')
+    rebalance = commands.add_parser('rebalance', help='Move every user to their default shard')
+    rebalance.add_argument('--dry-run', action='store_true', help='List moves without making them')
+    move = commands.add_parser('move', help='Move one user')
+    move.add_argument('user_id', type=int)
+    move.add_argument('shard', help="Shard number or 'main'")
+    args = parser.parse_args(argv)
+
+    app = _open_app()
+    with app.app_context():
+        return {'status': cmd_status, 'rebalance': cmd_rebalance, 'move': cmd_move}[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql.util import find_tables
+
+# --- Per-user Shard Routing ---
+# With DB_SHARDS = N > 0, each user's notes, tags, note_tags, change log and
+# revisions live in one of N SQLite files (binds 'shard_0'..'shard_N-1'),
+# so users don't queue behind each other's write lock. `user` stays in the
+# main database and records which shard holds the user's data
+# (None = still in the main file, i.e. not migrated yet).
+# Routing is implicit: requests run with the logged-in user's shard selected
+# and ShardedSession sends per-user tables there.
+# Note and tag ids come from one sequence in the main database, so they are
+# unique across shards and stay the same when a user is moved.
+
+SHARDED_TABLES = {'note', 'tag', 'note_tags', 'change_event', 'note_revision'}
+MAIN = None          # Shard id meaning "the main database"
+_UNSET = object()
+
+_current_shard = ContextVar('current_shard', default=_UNSET)
+_current_owner = ContextVar('current_owner', default=None) # User whose shard is selected, if known
+
+
+class ShardMoved(Exception):
+    """The user was moved to another shard while this transaction was writing to the old one."""
+
+
+def bind_key(shard):
+    return f"shard_{shard}"
+
+
+def shard_binds(count, uri_template):
+    return {bind_key(n): uri_template.format(n) for n in range(count)}
+
+
+def shard_count():
+    return current_app.config['DB_SHARDS']
+
+
+def default_shard(user_id, count=None):
+    """Where a user's data belongs for the configured shard count (MAIN when unsharded)."""
+    count = shard_count() if count is None else count
+    if not count:
+        return MAIN
+    return zlib.crc32(str(user_id).encode()) % count
+
+
+def shard_of(user):
+    return user.shard if shard_count() else MAIN
+
+
+def all_shards():
+    # MAIN first: it still holds data for users not yet migrated
+    return [MAIN] + list(range(shard_count()))
+
+
+def shard_engine(shard, db):
+    return db.engines[None if shard is MAIN else bind_key(shard)]
+
+
+def current_shard():
+    shard = _current_shard.get()
+    return MAIN if shard is _UNSET else shard
+
+
+def _leave_shard():
+    # The session keys rows by class and id only, so rows loaded from one shard
+    # must not answer lookups made against another: write them out, then forget them
+    if not has_app_context():
+        return
+    session = current_app.extensions['sqlalchemy'].session
+    if not session.registry.has():
+        return
+    session = session()
+    sharded = [obj for obj in list(session.identity_map.values()) + list(session.new)
+               if _is_sharded(type(obj), None)]
+    if sharded:
+        session.flush()
+        for obj in sharded:
+            session.expunge(obj)
+
+
+def select_shard(shard, user_id=None):
+    if _current_shard.get() != shard:
+        _leave_shard()
+    _current_shard.set(shard)
+    _current_owner.set(user_id)
+
+
+def clear_shard():
+    _current_shard.set(_UNSET)
+    _current_owner.set(None)
+
+
+@contextmanager
+def using_shard(shard, user_id=None):
+    """Route per-user tables to `shard` for the duration of the block."""
+    switching = _current_shard.get() != shard
+    if switching: _leave_shard()
+    token = _current_shard.set(shard)
+    owner = _current_owner.set(user_id)
+    try:
+        yield
+    finally:
+        if switching: _leave_shard()
+        _current_owner.reset(owner)
+        _current_shard.reset(token)
+
+
+def sequence_id(db, connection):
+    """Next note/tag id, unique across the main database and every shard."""
+    table = db.metadata.tables['id_sequence']
+
+    def take(conn):
+        new_id = conn.execute(table.insert()).inserted_primary_key[0]
+        conn.execute(table.delete().where(table.c.id < new_id)) # AUTOINCREMENT remembers the high mark
+        return new_id
+
+    if connection.engine is db.engine:
+        return take(connection) # Row goes to main anyway: same transaction
+    with db.engine.begin() as conn:
+        return take(conn) # Committed before the row is written, so an id is never handed out twice
+
+
+def _is_sharded(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in SHARDED_TABLES
+    if clause is not None:
+        return any(getattr(t, 'name', None) in SHARDED_TABLES for t in find_tables(clause, include_crud=True))
+    return False
+
+
+class ShardedSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _is_sharded(mapper, clause):
+            shard = _current_shard.get()
+            if shard is _UNSET:
+                if self._db.engines.keys() - {None}:
+                    raise RuntimeError('Per-user table used with no shard selected (see sharding.using_shard)')
+            elif shard is not MAIN:
+                return self._db.engines[bind_key(shard)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def flush(self, objects=None):
+        try:
+            super().flush(objects)
+        except StaleDataError:
+            # UPDATE/DELETE matched no row: a move may have taken the user's rows away
+            check_home(self._db)
+            raise
+
+
+def _routing():
+    # (user id, shard) the current context writes for, or None when not checkable
+    user_id, shard = _current_owner.get(), _current_shard.get()
+    if user_id is None or shard is _UNSET or not has_app_context() \
+            or not current_app.extensions['sqlalchemy'].engines.keys() - {None}:
+        return None
+    return user_id, shard
+
+
+def _home(db, user_id, conn):
+    user = db.metadata.tables['user']
+    return conn.execute(sa.select(user.c.shard).where(user.c.id == user_id)).scalar()
+
+
+def check_home(db):
+    """Raise ShardMoved if the selected user's data no longer lives in the selected shard."""
+    routing = _routing()
+    if routing is None:
+        return
+    user_id, shard = routing
+    with db.engine.connect() as conn:
+        home = _home(db, user_id, conn)
+    if home != shard:
+        raise ShardMoved(f"user {user_id} moved from {shard} to {home}")
+
+
+@sa.event.listens_for(ShardedSession, 'before_commit')
+def _check_home(session):
+    # A move locks the user's old database, repoints user.shard, deletes the
+    # copied rows and commits. Once this transaction holds that database's
+    # write lock the move is either done or not started: if user.shard no
+    # longer points here, our writes would land in rows nobody reads.
+    routing = _routing()
+    if routing is None:
+        return
+    user_id, shard = routing
+    session.flush()
+    conn = session.connection(bind_arguments={'bind': shard_engine(shard, session._db)})
+    if not getattr(conn.connection.dbapi_connection, 'in_transaction', True):
+        return # Nothing written to the shard
+    home = _home(session._db, user_id, session.connection(bind_arguments={'bind': session._db.engine}))
+    if home != shard:
+        raise ShardMoved(f"user {user_id} moved from {shard} to {home}")
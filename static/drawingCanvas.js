@@ -368,7 +368,8 @@ class DrawingCanvas {
             .then(data => {
                 if(data.status === 'success') {
                     this.close();
-                    window.location.reload(); 
+                    // Change feed patches the card in place; reload only without it
+                    if(!(window.changeFeed && window.changeFeed.connected)) window.location.reload();
                 }
                 btn.innerText = originalText;
             });
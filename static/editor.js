@@ -31,17 +31,173 @@ window.syncContent = function(id, field, value) {
     }, 500); // 500ms delay
 }
 
-function saveData(id, field, value) {
+// Delta Autosave State: { id: { base, version, inFlight, queued, superseded } }
+// `base` is the exact content string the server acknowledged at `version`.
+const autosave = {};
+
+function saveData(id, field, value, base) {
+    // Content goes out as a small patch once we know the server's exact base
+    if (field === 'content' && autosave[id]) return savePatch(id, value);
+
+    const body = { [field]: value };
+    if (base) body.base = base.version; // Full save still only applies on top of what we last saw
     fetch(`/update/${id}`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ [field]: value })
-    }).then(r => {
-        // Optional: Show "Saved" indicator
-       // console.log("Saved", id);
+        body: JSON.stringify(body)
+    })
+    .then(r => r.json().then(data => ({ status: r.status, data, retry: retryDelay(r) })))
+    .then(({ status, data, retry }) => {
+        if (status === 503) {
+            // Note storage was moving: same save again, it goes to the new location
+            return setTimeout(() => {
+                if (field === 'content' && autosave[id]) return; // A newer save already landed
+                saveData(id, field, value, base);
+            }, retry);
+        }
+        if (field === 'content' && status === 409) {
+            // Saved elsewhere in the meantime: continue as patches on top of their version
+            const theirs = data.content || '';
+            const merged = resolveConflict(id, base ? base.text : null, value, theirs);
+            autosave[id] = { base: theirs, version: data.version };
+            if (merged !== value) autosave[id].superseded = { from: value, to: merged };
+            return savePatch(id, merged);
+        }
+        if (field === 'content' && data.version) {
+            autosave[id] = { base: value, version: data.version };
+            markVersion(id, data.version);
+        }
+    });
+}
+
+function savePatch(id, value) {
+    const state = autosave[id];
+    // A save scheduled before a merge still carries the pre-merge text
+    if (state.superseded && value === state.superseded.from) value = state.superseded.to;
+    if (state.inFlight) {
+        state.queued = value; // Only the latest text matters
+        return;
+    }
+
+    const ops = diffOps(state.base, value);
+    if (!ops.length) return;
+
+    state.inFlight = true;
+    fetch(`/notes/${id}/patch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ base: state.version, ops: ops })
+    })
+    .then(r => r.json().then(data => ({ status: r.status, data, retry: retryDelay(r) })))
+    .then(({ status, data, retry }) => {
+        state.inFlight = false;
+        if (status === 503) {
+            // Note storage was moving: resend (ids and versions move along), holding newer edits until then
+            state.inFlight = true;
+            return setTimeout(() => {
+                state.inFlight = false;
+                const next = state.queued !== undefined ? state.queued : value;
+                delete state.queued;
+                savePatch(id, next);
+            }, retry);
+        }
+        if (data.status === 'success') {
+            state.base = value;
+            state.version = data.version;
+            markVersion(id, data.version);
+        } else if (status === 409) {
+            // Someone else saved first: merge both edits onto their version, then re-send
+            const theirs = data.content || '';
+            const mine = state.queued !== undefined ? state.queued : value;
+            const merged = resolveConflict(id, state.base, mine, theirs);
+            if (merged !== mine) state.superseded = { from: mine, to: merged };
+            state.base = theirs;
+            state.version = data.version;
+            state.queued = merged;
+        } else {
+            // Rejected patch: fall back to a full save
+            delete autosave[id];
+            return saveData(id, 'content', state.queued !== undefined ? state.queued : value,
+                { text: state.base, version: state.version });
+        }
+
+        if (state.queued !== undefined) {
+            const next = state.queued;
+            delete state.queued;
+            savePatch(id, next);
+        }
+    })
+    .catch(() => {
+        delete autosave[id];
+        saveData(id, 'content', value, { text: state.base, version: state.version });
+    });
+}
+
+function retryDelay(response) {
+    // Retry-After in ms, for 503s (default 1s)
+    return (parseInt(response.headers.get('Retry-After'), 10) || 1) * 1000;
+}
+
+// Single replace op covering the changed middle (offsets in UTF-16 code units)
+function diffOps(base, value) {
+    if (base === value) return [];
+
+    const max = Math.min(base.length, value.length);
+    let start = 0;
+    while (start < max && base.charCodeAt(start) === value.charCodeAt(start)) start++;
+
+    let endBase = base.length, endValue = value.length;
+    while (endBase > start && endValue > start && base.charCodeAt(endBase - 1) === value.charCodeAt(endValue - 1)) {
+        endBase--;
+        endValue--;
+    }
+
+    return [{ at: start, del: endBase - start, ins: value.slice(start, endValue) }];
+}
+
+// Three-way merge of two single-region edits of `base`; null when they overlap
+function mergeText(base, mine, theirs) {
+    if (mine === theirs || theirs === base) return mine;
+    if (mine === base) return theirs;
+
+    const a = diffOps(base, mine)[0], b = diffOps(base, theirs)[0];
+    const [first, second] = a.at <= b.at ? [a, b] : [b, a];
+    if (first.at + first.del >= second.at) return null; // Same or touching region: a real conflict
+
+    return base.slice(0, first.at) + first.ins +
+        base.slice(first.at + first.del, second.at) + second.ins +
+        base.slice(second.at + second.del);
+}
+
+// Text to save on top of `theirs` after a conflict (`base`: last text both sides shared, if known)
+function resolveConflict(id, base, mine, theirs) {
+    if (mine === theirs) return mine;
+    const merged = base === null ? null : mergeText(base, mine, theirs);
+    if (merged === null) {
+        alert('This note was also changed somewhere else, in the same place you edited. Your text was kept; the other version is in the note history.');
+        return mine;
+    }
+    if (merged !== mine) showContent(id, merged);
+    return merged;
+}
+
+function showContent(id, value) {
+    // Put merged text in front of the user so their next edit builds on it
+    const card = document.querySelector(`.item-card[data-id="${id}"]`);
+    const modal = window.toolbar && String(window.toolbar.activeNoteId) === String(id)
+        ? document.querySelector('#modal-card-container .card') : null;
+    [card, modal].forEach(c => {
+        const body = c && c.querySelector('.item-body');
+        if (body && body.innerHTML !== value) body.innerHTML = value;
     });
 }
 
+function markVersion(id, version) {
+    // Lets the change feed skip our own saves
+    const card = document.querySelector(`.item-card[data-id="${id}"]`);
+    if (card) card.dataset.version = version;
+}
+
 // Action Handlers
 window.handleAddText = function(btn, id) {
     const card = document.querySelector(`.item-card[data-id="${id}"]`);
@@ -108,7 +264,8 @@ window.togglePin = function(id, status) {
         headers: {'Content-Type': 'application/json'},
         body: JSON.stringify({ pinned: status })
     }).then(() => {
-        window.location.reload(); // Re-sort needs reload
+        // Re-sort comes through the change feed; reload only without it
+        if(!(window.changeFeed && window.changeFeed.connected)) window.location.reload();
     });
 }
 
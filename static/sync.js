@@ -0,0 +1,208 @@
+/**
+ * =========================================================
+ * SYNC MODULE
+ * Live Change Feed (SSE) -> Incremental Grid Patches
+ * =========================================================
+ */
+class ChangeFeed {
+    constructor() {
+        this.grid = document.getElementById('notesGrid');
+        this.connected = false;
+        this.pending = new Map(); // noteId -> timeout (coalesce card refreshes)
+
+        if (!this.grid || this.grid.dataset.changeCursor === undefined) return;
+        this.cursor = parseInt(this.grid.dataset.changeCursor) || 0;
+        this.shard = this.grid.dataset.changeShard || ''; // Cursors are only valid within one database
+
+        if (window.EventSource) this.connect();
+        else this.startPolling();
+    }
+
+    connect() {
+        // Browser re-sends Last-Event-ID on reconnect, ?since only matters for the first open
+        this.source = new EventSource(`/changes/stream?since=${this.cursor}&shard=${this.shard}`);
+        this.source.onopen = () => { this.connected = true; };
+        this.source.onerror = () => { this.connected = false; }; // EventSource retries itself
+        this.source.onmessage = (e) => {
+            if (e.lastEventId) this.cursor = parseInt(e.lastEventId) || this.cursor;
+            this.apply(JSON.parse(e.data));
+        };
+        this.source.addEventListener('reset', () => window.location.reload());
+        this.source.addEventListener('poll', () => {
+            // Server is out of stream slots: use the catch-up API instead
+            this.source.close();
+            this.startPolling();
+        });
+    }
+
+    startPolling() {
+        // Fallback: Catch-up API
+        setInterval(() => {
+            fetch(`/changes?since=${this.cursor}&shard=${this.shard}`)
+            .then(r => r.json())
+            .then(data => {
+                if (data.reset) return window.location.reload();
+                data.events.forEach(event => this.apply(event));
+                this.cursor = data.cursor;
+            });
+        }, 10000);
+    }
+
+    apply(event) {
+        const id = event.note_id;
+        switch (event.kind) {
+            case 'note.updated':
+                this.patchFields(id, event.data.fields || {}, event.data.version);
+                break;
+            case 'note.patched':
+                // Patches are against the server's exact text, which the DOM doesn't keep;
+                // re-render the card unless it already has this version (our own save)
+                this.refreshCard(id, event.data.version);
+                break;
+            case 'note.tags':
+                this.renderTags(id, event.data.tags || []);
+                break;
+            case 'note.created':
+            case 'note.restored':
+            case 'note.media':
+                this.refreshCard(id);
+                break;
+            case 'note.deleted':
+            case 'note.purged':
+                this.removeCard(id);
+                break;
+            case 'tag.created':
+                this.addLabel(event.data.tag);
+                break;
+        }
+    }
+
+    gridCard(id) {
+        return this.grid.querySelector(`.item-card[data-id="${id}"]`);
+    }
+
+    modalCard(id) {
+        // Modal clone only corresponds to the note the toolbar is editing
+        if (!window.toolbar || String(window.toolbar.activeNoteId) !== String(id)) return null;
+        return document.querySelector('#modal-card-container .card');
+    }
+
+    patchFields(id, fields, version) {
+        const grid = this.gridCard(id);
+        if (grid && version && 'content' in fields) grid.dataset.version = version;
+
+        if ('pinned' in fields) {
+            // Pin changes re-order the grid
+            this.refreshCard(id);
+            return;
+        }
+
+        [this.gridCard(id), this.modalCard(id)].forEach(card => {
+            if (!card) return;
+            if ('title' in fields) {
+                const el = card.querySelector('.item-title');
+                // Never clobber what the user is typing right now
+                if (el && el !== document.activeElement && el.innerText !== fields.title) el.innerText = fields.title;
+            }
+            if ('content' in fields) {
+                const el = card.querySelector('.item-body');
+                if (el && el !== document.activeElement && el.innerHTML !== fields.content) el.innerHTML = fields.content;
+            }
+        });
+    }
+
+    renderTags(id, tags) {
+        [this.gridCard(id), this.modalCard(id)].forEach(card => {
+            if (!card) return;
+            const container = card.querySelector('.tags-container');
+            if (!container) return;
+
+            container.innerHTML = '';
+            tags.forEach(tag => {
+                const chip = document.createElement('span');
+                chip.className = 'tag-chip';
+                chip.dataset.id = tag.id;
+                chip.innerText = tag.name;
+                chip.onclick = (e) => window.setSearch(tag.name, e);
+                container.appendChild(chip);
+            });
+        });
+    }
+
+    addLabel(tag) {
+        if (!tag || !window.labelController || !window.labelController.bar) return;
+        if (window.labelController.bar.querySelector(`.filter-chip[data-id="${tag.id}"]`)) return;
+        window.labelController.renderChip(tag);
+    }
+
+    removeCard(id) {
+        const card = this.gridCard(id);
+        if (card) card.remove();
+        if (this.modalCard(id) && window.closeModal) window.closeModal();
+    }
+
+    refreshCard(id, version) {
+        // Several events for one note often arrive together (e.g. upload of N files)
+        clearTimeout(this.pending.get(id));
+        this.pending.set(id, setTimeout(() => {
+            this.pending.delete(id);
+            const card = this.gridCard(id);
+            if (version && card && parseInt(card.dataset.version) >= version) return;
+            this.fetchCard(id);
+        }, 100));
+    }
+
+    fetchCard(id) {
+        fetch(`/notes/${id}/card`)
+        .then(r => {
+            if (r.status === 404) {
+                this.removeCard(id);
+                return null;
+            }
+            return r.ok ? r.text() : null;
+        })
+        .then(html => {
+            if (!html) return;
+            const tpl = document.createElement('template');
+            tpl.innerHTML = html.trim();
+            const card = tpl.content.querySelector('.item-card');
+            if (card) this.placeCard(card);
+        });
+    }
+
+    placeCard(card) {
+        const id = card.dataset.id;
+        const existing = this.gridCard(id);
+        const wasPinned = existing && existing.classList.contains('pinned');
+        const isPinned = card.classList.contains('pinned');
+
+        card.addEventListener('click', (e) => {
+            if (e.target.closest('button') || e.target.closest('a') || e.target.closest('.card-actions')) return;
+            window.openModal(card);
+        });
+
+        if (existing && wasPinned === isPinned) {
+            existing.replaceWith(card);
+        } else {
+            if (existing) existing.remove();
+            const empty = this.grid.querySelector('.empty-state');
+            if (empty) empty.remove();
+
+            // Same order as index(): pinned first, then newest first
+            const anchor = isPinned
+                ? this.grid.querySelector('.item-card')
+                : this.grid.querySelector('.item-card:not(.pinned)');
+            this.grid.insertBefore(card, anchor);
+        }
+
+        // Keep an open modal in step, unless the user is editing inside it
+        const modalCard = this.modalCard(id);
+        const modalContainer = document.getElementById('modal-card-container');
+        if (modalCard && !modalContainer.contains(document.activeElement)) window.openModal(card);
+
+        if (window.lucide) lucide.createIcons();
+        if (window.resizeAllMasonryItems) window.resizeAllMasonryItems();
+    }
+}
+
+window.changeFeed = new ChangeFeed();
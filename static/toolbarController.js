@@ -75,6 +75,12 @@ class ToolbarController {
                     tagInput.value = '';
                 }
             });
+
+            // Autocomplete as you type (debounced)
+            tagInput.addEventListener('input', () => {
+                clearTimeout(this.suggestTimeout);
+                this.suggestTimeout = setTimeout(() => this.loadTags(tagInput.value.trim()), 120);
+            });
         }
 
         // Selection Change -> Update Active States
@@ -186,15 +192,23 @@ class ToolbarController {
         }
     }
 
-    loadTags() {
-        fetch('/tags')
+    loadTags(query = '') {
+        // Server ranks and caps the list; only the matching top few come down
+        const requestId = this.suggestRequestId = (this.suggestRequestId || 0) + 1;
+        fetch(`/tags/suggest?q=${encodeURIComponent(query)}`)
         .then(r => r.json())
         .then(tags => {
+            if(requestId !== this.suggestRequestId) return; // A newer keystroke won
             const container = document.getElementById('tag-suggestions');
             if(container) {
-                container.innerHTML = tags.map(t => 
-                    `<span class="tag-chip" onclick="toolbar.addTag('${t.name}')">${t.name}</span>`
-                ).join('');
+                container.innerHTML = '';
+                tags.forEach(t => {
+                    const chip = document.createElement('span');
+                    chip.className = 'tag-chip';
+                    chip.innerText = t.name;
+                    chip.onclick = () => this.addTag(t.name);
+                    container.appendChild(chip);
+                });
             }
         });
     }
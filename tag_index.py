@@ -0,0 +1,188 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from sqlalchemy import event, func
+
+from extensions import db
+from models import Tag, note_tags
+from sharding import ShardedSession, current_shard
+
+# --- Tag Autocomplete Index ---
+# One sorted (lowercase name) array per user, so a prefix is a bisect range
+# instead of a table scan. Indexes live per worker process and are shared by
+# its threads (each index has its own lock): mutations made here update it in
+# place once their transaction commits, other workers pick them up after INDEX_TTL.
+#
+# "Recent" means the tag sits on a newer note: note ids only grow, so the
+# highest note id carrying a tag stands in for when it was last applied.
+
+DEFAULT_SUGGESTIONS = 8
+MAX_SUGGESTIONS = 20       # Hard cap, whatever the client asks for
+INDEX_TTL = 30             # Seconds before a worker re-reads a user's tags
+MAX_USERS = 256            # Indexes kept per process (LRU)
+MAX_CACHED_QUERIES = 128   # Responses cached per user index
+
+_lock = threading.Lock()
+_indexes = OrderedDict()   # (user_id, shard) -> TagIndex
+
+
+def _prefix_end(prefix):
+    # Smallest string above every string starting with `prefix` (None: no bound)
+    prefix = prefix.rstrip('\U0010ffff')
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+class TagIndex:
+    def __init__(self, rows):
+        # rows: (id, name, color, use_count, last_note_id)
+        self.lock = threading.Lock() # suggest() reads, add()/used() write, from any request thread
+        self.entries = {}
+        for tag_id, name, color, count, last_note_id in rows:
+            self.entries[tag_id] = {'id': tag_id, 'name': name, 'color': color,
+                                    'count': count or 0, 'last': last_note_id or 0}
+        self._rebuild()
+        self.built_at = time.monotonic()
+
+    def _rebuild(self):
+        ordered = sorted(self.entries.values(), key=lambda e: (e['name'].lower(), e['id']))
+        self.keys = [e['name'].lower() for e in ordered]
+        self.ids = [e['id'] for e in ordered]
+        self.by_name = {e['name']: e['id'] for e in ordered}
+        self.cache = OrderedDict()
+
+    def lookup(self, name):
+        with self.lock:
+            return self.by_name.get(name)
+
+    def suggest(self, prefix, limit):
+        with self.lock:
+            return self._suggest(prefix, limit)
+
+    def _suggest(self, prefix, limit):
+        key = (prefix, limit)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if prefix:
+            start = bisect_left(self.keys, prefix)
+            bound = _prefix_end(prefix)
+            end = bisect_left(self.keys, bound, start) if bound else len(self.keys)
+            candidates = (self.entries[i] for i in self.ids[start:end])
+        else:
+            candidates = self.entries.values()
+
+        # Most used first, then on the newest note (see above), then newest tag
+        top = heapq.nlargest(limit, candidates, key=lambda e: (e['count'], e['last'], e['id']))
+        result = [{'id': e['id'], 'name': e['name'], 'color': e['color'], 'count': e['count']} for e in top]
+
+        self.cache[key] = result
+        if len(self.cache) > MAX_CACHED_QUERIES:
+            self.cache.popitem(last=False)
+        return result
+
+    def add(self, tag_id, name, color):
+        with self.lock:
+            self.entries[tag_id] = {'id': tag_id, 'name': name, 'color': color, 'count': 0, 'last': 0}
+            self._rebuild()
+
+    def used(self, tag_id, note_id, delta):
+        with self.lock:
+            entry = self.entries.get(tag_id)
+            if entry:
+                entry['count'] = max(entry['count'] + delta, 0)
+                if delta > 0: entry['last'] = max(entry['last'], note_id)
+                self.cache.clear()
+
+
+# Index updates wait for the commit: a rolled-back tag must not be suggested
+PENDING = 'tag_index.pending'
+
+
+def _on_commit(update):
+    db.session.info.setdefault(PENDING, []).append(update)
+
+
+@event.listens_for(ShardedSession, 'after_commit')
+def _apply_pending(session):
+    for update in session.info.pop(PENDING, []):
+        update()
+
+
+@event.listens_for(ShardedSession, 'after_rollback')
+def _drop_pending(session):
+    session.info.pop(PENDING, None)
+
+
+def _load(user_id):
+    rows = db.session.query(
+        Tag.id, Tag.name, Tag.color,
+        func.count(note_tags.c.note_id), func.max(note_tags.c.note_id)
+    ).outerjoin(note_tags, note_tags.c.tag_id == Tag.id)\
+        .filter(Tag.user_id == user_id).group_by(Tag.id).all()
+    return TagIndex(rows)
+
+
+def get_index(user_id):
+    key = (user_id, current_shard()) # A user moved to another shard starts from a fresh index
+    with _lock:
+        index = _indexes.get(key)
+        if index and time.monotonic() - index.built_at < INDEX_TTL:
+            _indexes.move_to_end(key)
+            return index
+
+    index = _load(user_id)
+    with _lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _cached(user_id):
+    # Only touch an index that is already loaded; a cold one is built fresh anyway
+    with _lock:
+        return _indexes.get((user_id, current_shard()))
+
+
+def suggest_tags(user_id, prefix, limit=DEFAULT_SUGGESTIONS):
+    limit = min(max(limit, 1), MAX_SUGGESTIONS)
+    return get_index(user_id).suggest(prefix.strip().lower(), limit)
+
+
+def find_or_create_tag(user_id, name):
+    """Return the user's tag called `name`, creating it (flushed, not committed) if needed.
+
+    Second value is True when the tag was created.
+    """
+    index = _cached(user_id)
+    tag = None
+    tag_id = index.lookup(name) if index else None
+    if tag_id is not None:
+        tag = db.session.get(Tag, tag_id) # Identity map / PK lookup
+    if tag is None or tag.user_id != user_id or tag.name != name:
+        tag = Tag.query.filter_by(user_id=user_id, name=name).first()
+    if tag:
+        return tag, False
+
+    tag = Tag(user_id=user_id, name=name)
+    db.session.add(tag)
+    db.session.flush() # Get ID without commit yet
+    if index:
+        entry = (tag.id, tag.name, tag.color) # Read now: attributes expire at commit
+        _on_commit(lambda: index.add(*entry))
+    return tag, True
+
+
+def tag_applied(user_id, tag_id, note_id):
+    index = _cached(user_id)
+    if index: _on_commit(lambda: index.used(tag_id, note_id, 1))
+
+
+def tag_removed(user_id, tag_id, note_id):
+    index = _cached(user_id)
+    if index: _on_commit(lambda: index.used(tag_id, note_id, -1))
@@ -1,6 +1,4 @@
-from app import app
-from extensions import db
+from app import create_app, init_schema
 
-with app.app_context():
-    db.create_all()
-    print("Database schema updated: Tags tables created.")
+init_schema(create_app())
+print("Database schema updated: Tags tables created.")